@@ -1,27 +1,56 @@
 import os
 import io
+import re
 import gpgme
 import json
 import time
+import zlib
+import hmac
 import codecs
-import datetime
-import gi
-gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk
-from gi.repository import GObject
-from gi.repository import Gdk
+import hashlib
+import functools
+import contextlib
 
+from . import trace
+from . import usage
 from .version import __version__
+from .entry import Entry, entry_hook, entry_default
+from .policy import Policy, PolicyError
+from .index import ContextIndex, MetaIndex, scan
+from .storage import FileStorage
+from .crypto import default_crypto
+from .federation import Federation
 
 ############################################################
 
 DEFAULT_NEW_PASSWORD_OCTETS = 18
 
+# journal size in bytes past which save() compacts the journal into
+# the database file
+DEFAULT_JOURNAL_LIMIT = 1 << 20
+
+# leading whitespace and the opening brace of a json object, matched
+# in place rather than stripping a copy of the data
+_JSON_START = re.compile(rb'\s*{')
+
+def _entry_context(jsondata, obj):
+    # context of the entry obj in a parsed database file, shard or
+    # journal record, for reporting it
+    if not isinstance(jsondata, dict):
+        return None
+    for context, entry in jsondata.get('entries', {}).items():
+        if entry is obj:
+            return context
+    for change in jsondata.get('changes', ()):
+        if change.get('entry') is obj:
+            return change.get('context')
+    return None
+
 def pwgen(nbytes):
     """Return *nbytes* bytes of random data, base64-encoded."""
     s = os.urandom(nbytes)
     b = codecs.encode(s, 'base64')
-    b = bytes(filter(lambda x: x not in b'=\n', b))
+    b = b.translate(None, b'=\n')
     return codecs.decode(b, 'ascii')
 
 ############################################################
@@ -32,14 +61,93 @@ class DatabaseError(Exception):
     def __str__(self):
         return repr(self.msg)
 
+def check_meta(username=None, url=None, tags=None):
+    """Dict of the given optional entry fields, after checking them.
+
+    Raises DatabaseError if username or url is not a string, or tags
+    is not a list of non-empty strings.
+
+    """
+    meta = {}
+    for name, value in (('username', username), ('url', url)):
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            raise DatabaseError("%s must be a string" % name)
+        meta[name] = value
+    if tags is not None:
+        if not isinstance(tags, (list, tuple)) \
+           or not all(isinstance(t, str) and t for t in tags):
+            raise DatabaseError("tags must be a list of non-empty strings")
+        # each tag once, in the order given
+        meta['tags'] = list(dict.fromkeys(tags))
+    return meta
+
 class Database():
     """An Assword database."""
 
-    def __init__(self, dbpath=None, keyid=None):
+    def __init__(self, dbpath=None, keyid=None, compress=None, shards=None,
+                 journal=None, journal_limit=DEFAULT_JOURNAL_LIMIT,
+                 storage=None, hooks=None, crypto=None):
         """Database at dbpath will be decrypted and loaded into memory.
 
         If dbpath not specified, empty database will be initialized.
 
+        The database is read from and saved to storage, a storage
+        backend from assword.storage, or if storage is not given a
+        FileStorage at dbpath.
+
+        hooks is a dict of lists of callables to call with the
+        database: 'pre-open' hooks before the database is read, and
+        'post-save' hooks after each save().  See
+        assword.storage.CommandHook for hooks running external
+        commands, optionally in the background.  A failing pre-open
+        hook raises DatabaseError; a failing post-save hook does not
+        make the save fail, as the database has already been written,
+        and its error is kept in the hook_errors property instead.
+
+        Encryption is done with crypto, an assword.crypto.Crypto, or
+        if crypto is not given the one shared by the whole process.
+        To use an existing gpgme context pass Crypto(context).
+
+        If dbpath is a directory it holds a sharded database: entries
+        are spread over separately encrypted shard files, which are
+        only decrypted when an entry in them is needed, and save()
+        only rewrites the shards that have changed.  If dbpath does
+        not exist and shards is given, a new sharded database with
+        that many shards will be created there on save().
+
+        Entries are returned as assword.Entry objects, read-only
+        mappings with 'password' and 'date' keys, and any of the
+        optional 'username', 'url' and 'tags' keys that are set.
+
+        Databases are saved in the compact version 2 format, and
+        version 1 databases are converted when they are next saved.
+        If compress is True the database is zlib compressed before
+        it is encrypted, if False it is not.  If compress is None the
+        setting of the existing database is kept, and new databases
+        are not compressed.
+
+        Retrievals of entries counted with record_use() are kept, for
+        ranking, in a separately encrypted usage blob next to the
+        database (dbpath + '.usage'), which is only read when the usage
+        is needed and is written by save() and save_usage().
+
+        If journal is True, save() appends the changes made since the
+        last save as an encrypted record to a journal file next to a
+        single file database (dbpath + '.journal'), instead of
+        rewriting the whole database.  The journal is replayed when the
+        database is loaded, and folded back into the database file by
+        compact(), or by save() once it is larger than journal_limit
+        bytes.  If journal is None, journaling is used if the database
+        already has a journal.
+
+        Reading and saving the database take an advisory lock on the
+        storage.  If the stored database has been changed by
+        another writer since it was loaded, save() merges those changes
+        with the ones made here, keeping whichever version of each
+        entry has the most recent date.
+
         The sigvalid property is set False if any OpenPGP signatures
         on the db file are invalid.  sigvalid is None for new
         databases.
@@ -47,43 +155,134 @@ class Database():
         """
         self._dbpath = dbpath
         self._keyid = keyid
+        if storage is None and dbpath:
+            storage = FileStorage(dbpath)
+        self._storage = storage
+        self._hooks = hooks or {}
+        # errors of the post-save hooks run by the last save
+        self._hook_errors = []
 
         # default database information
         self._type = 'assword'
-        self._version = 1
+        self._version = 2
         self._entries = {}
-
-        self._gpg = gpgme.Context()
-        self._gpg.armor = True
+        self._index = None
+        self._meta_index = None
+        # None until known: if not given, whether the database is
+        # compressed is taken from how it is stored when it is loaded
+        self._compress = compress
+
+        # sharded layout: number of shards, key used to assign
+        # contexts to shards, contexts of the loaded shards by shard
+        # number, and shards changed since the last save
+        self._nshards = None
+        self._shardkey = None
+        self._shards = {}
+        self._dirty = set()
+
+        # contexts changed since the last save, in order, with the
+        # timestamp of the change
+        self._changed = {}
+        self._journal = False
+        self._journal_limit = journal_limit
+        # set if the last journal record was only partly written
+        self._journal_truncated = False
+
+        # stat of each blob as last read or written, to detect
+        # changes made by other writers
+        self._stats = {}
+
+        # uses of contexts (see assword.usage): as saved, loaded on
+        # first use, and as recorded since then
+        self._usage = None
+        self._usage_pending = {}
+
+        # worker for save_async(), started on first use
+        self._executor = None
+
+        self._crypto = crypto or default_crypto()
         self._sigvalid = None
 
-        if self._dbpath and os.path.exists(self._dbpath):
-            try:
-                cleardata = self._decryptDB(self._dbpath)
-                # FIXME: trap exception if json corrupt
-                jsondata = json.loads(cleardata.getvalue().decode('utf-8'))
-            except IOError as e:
-                raise DatabaseError(e)
-            except gpgme.GpgmeError as e:
-                raise DatabaseError('Decryption error: %s' % (e[2]))
-
-            # unpack the json data
-            if 'type' not in jsondata or jsondata['type'] != self._type:
-                raise DatabaseError('Database is not a proper assword database.')
-            if 'version' not in jsondata or jsondata['version'] != self._version:
-                raise DatabaseError('Incompatible database.')
-            self._entries = jsondata['entries']
+        self._run_hooks('pre-open')
+
+        if self._storage and self._storage.exists() and self._storage.sharded:
+            with trace.span('load', path=str(self._storage)), self._storage.lock():
+                self._read_manifest()
+        elif self._storage and self._storage.exists():
+            with trace.span('load', path=str(self._storage)) as span, self._storage.lock():
+                self._entries = self._read_file()
+                span['entries'] = len(self._entries)
+            self._journal = self._stats['journal'] is not None
+        elif shards:
+            self._nshards = shards
+            self._shardkey = os.urandom(32)
+            self._shards = {i: set() for i in range(shards)}
+
+        if self._compress is None:
+            self._compress = False
+        if journal is not None:
+            self._journal = journal
 
     @property
     def version(self):
         """Database version."""
         return self._version
 
+    @property
+    def compress(self):
+        """True if the database is compressed when saved."""
+        return self._compress
+
+    @compress.setter
+    def compress(self, value):
+        self._compress = bool(value)
+
+    @property
+    def journal(self):
+        """True if save() appends changes to the journal."""
+        return self._journal
+
+    @journal.setter
+    def journal(self, value):
+        self._journal = bool(value)
+
+    @property
+    def path(self):
+        """Path of the database, or None."""
+        return self._dbpath
+
+    @property
+    def storage(self):
+        """Storage backend of the database, or None."""
+        return self._storage
+
+    @property
+    def shards(self):
+        """Number of shards, or None if the database is a single file."""
+        return self._nshards
+
     @property
     def sigvalid(self):
         """Validity of OpenPGP signature on db file."""
         return self._sigvalid
 
+    @property
+    def journal_truncated(self):
+        """True if the last journal record was only partly written.
+
+        Such a record is left by a save interrupted while it appended
+        to the journal, and is ignored: its changes were never saved.
+        The next save rewrites the database file rather than appending
+        to the journal, which removes it.
+
+        """
+        return self._journal_truncated
+
+    @property
+    def hook_errors(self):
+        """List of the errors of the post-save hooks run by the last save."""
+        return list(self._hook_errors)
+
     def __str__(self):
         return '<assword.Database "%s">' % (self._dbpath)
 
@@ -92,72 +291,313 @@ class Database():
 
     def __getitem__(self, context):
         """Return database entry for exact context."""
+        self._load_context(context)
         return self._entries[context]
 
     def __contains__(self, context):
         """True if context string in database."""
+        self._load_context(context)
         return context in self._entries
 
     def __iter__(self):
         """Iterator of all database contexts."""
+        self._load_all()
         return iter(self._entries)
 
-    def _decryptDB(self, path):
-        data = io.BytesIO()
-        with io.BytesIO() as encdata:
-            with open(path, 'rb') as f:
-                encdata.write(f.read())
-                encdata.seek(0)
-                sigs = self._gpg.decrypt_verify(encdata, data)
-        # check signature
-        if not sigs[0].validity >= gpgme.VALIDITY_FULL:
+    def _run_hooks(self, point):
+        # Errors of post-save hooks are returned rather than raised:
+        # the database is already written, and must not be taken to
+        # have failed to save.
+        errors = []
+        for hook in self._hooks.get(point, []):
+            try:
+                hook(self)
+            except Exception as e:
+                error = '%s hook failed: %s' % (point, e)
+                if point != 'post-save':
+                    raise DatabaseError(error)
+                errors.append(error)
+        return errors
+
+    def _decrypt(self, encdata):
+        data, valid = self._crypto.decrypt_verify(encdata)
+        # check signature; a sharded database is only valid if all
+        # of the files read from it are
+        if not valid:
             self._sigvalid = False
-        else:
+        elif self._sigvalid is None:
             self._sigvalid = True
-        data.seek(0)
         return data
 
-    def _encryptDB(self, data, keyid):
+    def _read(self, name, dbtype=None):
+        try:
+            # decrypt straight from the store, rather than reading
+            # the whole encrypted blob into memory first
+            with trace.span('decrypt', blob=name) as span, \
+                 self._storage.open(name) as encdata:
+                cleardata = self._decrypt(encdata)
+                span['bytes'] = len(cleardata.getvalue())
+            # FIXME: trap exception if json corrupt
+            with trace.span('parse', blob=name, bytes=span['bytes']) as span:
+                jsondata = self._decode(cleardata)
+                span['entries'] = len(jsondata.get('entries', ()))
+        except IOError as e:
+            raise DatabaseError(e)
+        except gpgme.GpgmeError as e:
+            raise DatabaseError('Decryption error: %s' % (e.args[2]))
+
+        # check the json data
+        if 'type' not in jsondata or jsondata['type'] != (dbtype or self._type):
+            raise DatabaseError('Database is not a proper assword database.')
+        if 'version' not in jsondata or jsondata['version'] not in (1, self._version):
+            raise DatabaseError('Incompatible database.')
+        return jsondata
+
+    def _write(self, storage, name, jsondata, keyid):
+        with trace.span('encode', blob=name) as span:
+            cleardata = self._encode(jsondata)
+            clearsize = span['bytes'] = len(cleardata.getvalue())
+        with trace.span('write', blob=name) as span, storage.writer(name) as encdata:
+            with trace.span('encrypt', blob=name, bytes=clearsize):
+                self._encryptDB(cleardata, keyid, encdata)
+            span['bytes'] = encdata.tell()
+        if storage is self._storage:
+            self._stats[name] = storage.stat(name)
+
+    def _changed_on_disk(self, name):
+        return self._storage.stat(name) != self._stats.get(name)
+
+    def _resolve(self, theirs, mine, changed):
+        # entries of theirs, with the changes to the contexts in
+        # changed applied where they are more recent
+        merged = dict(theirs)
+        for context in changed:
+            entry = mine.get(context)
+            other = theirs.get(context)
+            if other is not None and other.timestamp > self._changed[context]:
+                continue
+            if entry is None:
+                merged.pop(context, None)
+            else:
+                merged[context] = entry
+        return merged
+
+    def _read_file(self):
+        # entries of a single file database and its journal
+        for name in ('db', 'journal'):
+            self._stats[name] = self._storage.stat(name)
+        if self._stats['db'] is None:
+            return {}
+        entries = self._read('db')['entries']
+        self._journal_truncated = False
+        if self._stats['journal'] is not None:
+            self._replay_journal(entries)
+        return entries
+
+    def _merge_file(self):
+        if not (self._changed_on_disk('db') or self._changed_on_disk('journal')):
+            return
+        self._entries = self._resolve(self._read_file(), self._entries, self._changed)
+        self._index = None
+        self._meta_index = None
+
+    def _replay_journal(self, entries):
+        with trace.span('replay', blob='journal') as span:
+            data = self._storage.read('journal')
+            # records are armored messages appended one after the other
+            marker = b'-----BEGIN PGP MESSAGE-----'
+            end = b'-----END PGP MESSAGE-----'
+            blocks = data.split(marker)[1:]
+            span['bytes'] = len(data)
+            span['records'] = len(blocks)
+            for n, block in enumerate(blocks, 1):
+                if n == len(blocks) and end not in block:
+                    # cut short by a save that was interrupted while
+                    # appending it
+                    self._journal_truncated = span['truncated'] = True
+                    break
+                try:
+                    jsondata = self._decode(self._decrypt(io.BytesIO(marker + block)))
+                except gpgme.GpgmeError as e:
+                    raise DatabaseError('Decryption error: %s' % (e.args[2]))
+                if jsondata.get('type') != 'assword-journal':
+                    raise DatabaseError('Database journal is corrupt.')
+                # replaying a change more than once has no further effect,
+                # so a journal left behind by an interrupted compaction
+                # is harmless
+                for change in jsondata['changes']:
+                    if change['op'] == 'set':
+                        entries[change['context']] = change['entry']
+                    else:
+                        entries.pop(change['context'], None)
+
+    def _append_journal(self, keyid):
+        changes = []
+        for context in self._changed:
+            if context in self._entries:
+                changes.append({'op': 'set',
+                                'context': context,
+                                'entry': self._entries[context]})
+            else:
+                changes.append({'op': 'remove',
+                                'context': context})
+        jsondata = {'type': 'assword-journal',
+                    'version': self._version,
+                    'changes': changes}
+        with trace.span('encode', blob='journal', entries=len(changes)) as span:
+            cleardata = self._encode(jsondata)
+            span['bytes'] = len(cleardata.getvalue())
+        with trace.span('encrypt', blob='journal', bytes=span['bytes']):
+            encdata = self._encryptDB(cleardata, keyid)
+        with trace.span('write', blob='journal', bytes=len(encdata.getvalue())):
+            self._storage.append('journal', encdata.getvalue())
+        self._stats['journal'] = self._storage.stat('journal')
+
+    def _shard(self, context):
+        # keyed, so that shard files do not reveal which contexts
+        # they hold
+        digest = hmac.new(self._shardkey, context.encode('utf-8'), hashlib.sha256).digest()
+        return int.from_bytes(digest[:4], 'big') % self._nshards
+
+    def _shardname(self, shard):
+        return 'shard-%04d' % shard
+
+    def _read_manifest(self):
+        self._stats['manifest'] = self._storage.stat('manifest')
+        jsondata = self._read('manifest')
+        if jsondata.get('layout') != 'sharded':
+            raise DatabaseError('Incompatible database.')
+        self._nshards = jsondata['shards']
+        self._shardkey = codecs.decode(jsondata['key'], 'hex')
+
+    def _read_shard(self, shard):
+        name = self._shardname(shard)
+        self._stats[name] = self._storage.stat(name)
+        if self._stats[name] is None:
+            return {}
+        return self._read(name, 'assword-shard')['entries']
+
+    def _load_shard(self, shard):
+        if shard in self._shards:
+            return
+        with self._storage.lock():
+            entries = self._read_shard(shard)
+        self._entries.update(entries)
+        self._shards[shard] = set(entries)
+
+    def _merge_shards(self):
+        if self._changed_on_disk('manifest'):
+            # another writer created the database first, so use its
+            # shard layout for the entries added here
+            mine = self._entries
+            self._read_manifest()
+            self._entries = {}
+            self._shards = {}
+            self._dirty = set(self._shard(context) for context in self._changed)
+        else:
+            mine = self._entries
+        for shard in self._dirty:
+            if shard in self._shards \
+               and not self._changed_on_disk(self._shardname(shard)):
+                continue
+            changed = [c for c in self._changed if self._shard(c) == shard]
+            merged = self._resolve(self._read_shard(shard), mine, changed)
+            for context in self._shards.get(shard, ()):
+                del self._entries[context]
+            self._entries.update(merged)
+            self._shards[shard] = set(merged)
+        self._index = None
+        self._meta_index = None
+
+    def _load_context(self, context):
+        if self._nshards is not None:
+            self._load_shard(self._shard(context))
+
+    def _load_all(self):
+        if self._nshards is not None and len(self._shards) < self._nshards:
+            for shard in range(self._nshards):
+                self._load_shard(shard)
+
+    def _decode(self, cleardata):
+        # getvalue() shares the BytesIO buffer rather than copying it
+        data = cleardata.getvalue()
+        # Version 1 databases, and uncompressed version 2 databases,
+        # are plain json objects.  A zlib stream can not start with
+        # '{', so anything else is taken to be compressed.
+        if not _JSON_START.match(data):
+            try:
+                data = zlib.decompress(data)
+            except zlib.error as e:
+                raise DatabaseError('Decompression error: %s' % e)
+            if self._compress is None:
+                self._compress = True
+        # json decodes the utf-8 itself, so the only copy made is
+        # the one str it parses
+        invalid = []
+        jsondata = json.loads(data, object_hook=functools.partial(entry_hook, invalid=invalid))
+        if invalid:
+            obj, error = invalid[0]
+            raise DatabaseError('Invalid entry for context %r: %s'
+                                % (_entry_context(jsondata, obj), error))
+        return jsondata
+
+    def _encode(self, jsondata):
+        # Returns a BytesIO of the cleartext.  Each intermediate is
+        # dropped as soon as the next is made, so that no more than
+        # two copies of the database are held at once.
+        data = json.dumps(jsondata, ensure_ascii=False,
+                          separators=(',', ':'), default=entry_default)
+        data = data.encode('utf-8')
+        if self._compress:
+            data = zlib.compress(data)
+        # a BytesIO made from bytes shares them until written to
+        return io.BytesIO(data)
+
+    def _encryptDB(self, data, keyid, encdata=None):
         # The signer and the recipient are assumed to be the same.
         # FIXME: should these be separated?
+        keyid = keyid or self._keyid
         try:
-            recipient = self._gpg.get_key(keyid or self._keyid)
-            signer = self._gpg.get_key(keyid or self._keyid)
+            self._crypto.get_key(keyid)
         except:
             raise DatabaseError('Could not retrieve GPG encryption key.')
-        flags = gpgme.ENCRYPT_ALWAYS_TRUST
-        try:
-            flags |= gpgme.ENCRYPT_NO_COMPRESS
-        except AttributeError:
-            pass
-        self._gpg.signers = [signer]
-        encdata = io.BytesIO()
-        data.seek(0)
-        sigs = self._gpg.encrypt_sign([recipient],
-                                      flags,
-                                      data,
-                                      encdata)
-        encdata.seek(0)
-        return encdata
-
-    def _set_entry(self, context, password=None):
-        if not isinstance(password, str):
+        return self._crypto.encrypt_sign(data, keyid, encdata)
+
+    def _set_entry(self, context, password=None, meta=None):
+        if isinstance(password, Policy):
+            password = password.generate()
+        elif not isinstance(password, str):
             if password is None:
                 bytes = DEFAULT_NEW_PASSWORD_OCTETS
             if isinstance(password, int):
                 bytes = password
             password = pwgen(bytes)
-        e = {'password': password,
-             'date': datetime.datetime.now().isoformat()}
+        e = Entry(password, **(meta or {}))
+        self._load_context(context)
+        if self._meta_index is not None and context in self._entries:
+            self._meta_index.remove(context, self._entries[context])
         self._entries[context] = e
+        self._changed[context] = e.timestamp
+        if self._nshards is not None:
+            shard = self._shard(context)
+            self._shards[shard].add(context)
+            self._dirty.add(shard)
+        if self._index is not None:
+            self._index.add(context)
+        if self._meta_index is not None:
+            self._meta_index.add(context, e)
         return e
 
-    def add(self, context, password=None):
+    def add(self, context, password=None, username=None, url=None, tags=None):
         """Add a new entry to the database.
 
         If password is None, one will be generated automatically.  If
         password is an int it will be interpreted as the number of
-        random bytes to use.
+        random bytes to use.  If password is an assword.Policy, one
+        will be generated according to the policy.
+
+        username and url (strings) and tags (a list of strings) are
+        stored with the entry if given.
 
         If the context is already in the db a DatabaseError will be
         raised.
@@ -170,14 +610,19 @@ class Database():
             raise DatabaseError("Can not add empty string context")
         if context in self:
             raise DatabaseError("Context already exists (see replace())")
-        return self._set_entry(context, password)
+        meta = check_meta(username, url, tags)
+        return self._set_entry(context, password, meta)
 
-    def replace(self, context, password=None):
+    def replace(self, context, password=None, username=None, url=None, tags=None):
         """Replace entry in database.
 
         If password is None, one will be generated automatically.  If
         password is an int it will be interpreted as the number of
-        random bytes to use.
+        random bytes to use.  If password is an assword.Policy, one
+        will be generated according to the policy.
+
+        The username, url and tags of the entry are kept unless new
+        ones are given; an empty string or list removes them.
 
         If the context is not in the db a DatabaseError will be
         raised.
@@ -188,7 +633,9 @@ class Database():
         """
         if context not in self:
             raise DatabaseError("Context not found (see add())")
-        return self._set_entry(context, password)
+        meta = self._entries[context].fields()
+        meta.update(check_meta(username, url, tags))
+        return self._set_entry(context, password, meta)
 
     def remove(self, context):
         """Remove an entry from the database.
@@ -197,7 +644,17 @@ class Database():
         is called.
 
         """
-        del self._entries[context]
+        self._load_context(context)
+        entry = self._entries.pop(context)
+        self._changed[context] = time.time()
+        if self._nshards is not None:
+            shard = self._shard(context)
+            self._shards[shard].discard(context)
+            self._dirty.add(shard)
+        if self._index is not None:
+            self._index.remove(context)
+        if self._meta_index is not None:
+            self._meta_index.remove(context, entry)
 
     def save(self, keyid=None, path=None):
         """Save database to disk.
@@ -205,6 +662,12 @@ class Database():
         Key ID must either be specified here or at database initialization.
         If path not specified, database will be saved at original dbpath location.
 
+        Sharded databases only rewrite the shards changed since the
+        last save, unless they are being saved to a new location.  If
+        the journal is in use (see the journal property) and the
+        database is saved to its original location, the changes since
+        the last save are appended to the journal.
+
         """
         # FIXME: should check that recipient is not different than who
         # the db was originally encrypted for
@@ -212,159 +675,314 @@ class Database():
             keyid = self._keyid
         if not keyid:
             raise DatabaseError('Key ID for decryption not specified.')
-        if not path:
-            path = self._dbpath
-        if not path:
+        if path and path != self._dbpath:
+            storage = FileStorage(path)
+        else:
+            storage = self._storage
+        if not storage:
             raise DatabaseError('Save path not specified.')
+        try:
+            with trace.span('save', path=str(storage)), storage.lock(exclusive=True):
+                self._save(keyid, storage)
+                if storage is self._storage and self._usage_pending:
+                    self._save_usage(keyid)
+                storage.saved()
+        except OSError as e:
+            raise DatabaseError(e)
+        self._hook_errors = self._run_hooks('post-save')
+
+    def save_async(self, keyid=None, path=None):
+        """Save database to disk in a background thread.
+
+        Takes the same arguments as save(), and returns a
+        concurrent.futures.Future whose result() returns once the
+        save is complete, or raises any error from the save.  Saves
+        are done one at a time, in the order they were requested.  The
+        database should not be changed until the save is complete.
+        The interpreter waits for outstanding saves before it exits.
+
+        """
+        if self._executor is None:
+            # only loaded by the callers that save in the background
+            import concurrent.futures
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self._executor.submit(self.save, keyid, path)
+
+    def _save(self, keyid, storage):
+        if self._nshards is not None:
+            self._save_shards(keyid, storage)
+            return
+        if storage is self._storage:
+            self._merge_file()
+            # a truncated journal record is dropped by rewriting the
+            # database file, rather than appended after
+            if self._journal and storage.stat('db') is not None \
+               and not self._journal_truncated \
+               and storage.size('journal') < self._journal_limit:
+                if self._changed:
+                    self._append_journal(keyid)
+                    self._changed = {}
+                return
+        self._save_snapshot(keyid, storage)
+
+    def _save_snapshot(self, keyid, storage):
         jsondata = {'type': self._type,
                     'version': self._version,
                     'entries': self._entries}
-        cleardata = io.BytesIO(json.dumps(jsondata, indent=2).encode('utf-8'))
-        encdata = self._encryptDB(cleardata, keyid)
-        newpath = path + '.new'
-        bakpath = path + '.bak'
-        with open(newpath, 'wb') as f:
-            f.write(encdata.getvalue())
-        if os.path.exists(path):
-            os.rename(path, bakpath)
-        os.rename(newpath, path)
-
-    def search(self, query=None):
-        """Search for query in contexts.
+        self._write(storage, 'db', jsondata, keyid)
+        if storage is self._storage:
+            # the journal has been folded into the new database file
+            storage.remove('journal')
+            self._stats['journal'] = None
+            self._journal_truncated = False
+            self._changed = {}
+
+    def compact(self, keyid=None):
+        """Fold the journal into a newly written database file.
 
-        If query is None, all entries will be returned.
+        Key ID must either be specified here or at database
+        initialization.  Sharded databases have no journal, and are
+        saved as with save().
+
+        """
+        if not keyid:
+            keyid = self._keyid
+        if not keyid:
+            raise DatabaseError('Key ID for decryption not specified.')
+        if not self._storage:
+            raise DatabaseError('Save path not specified.')
+        try:
+            with trace.span('compact', path=str(self._storage)), \
+                 self._storage.lock(exclusive=True):
+                if self._nshards is not None:
+                    self._save_shards(keyid, self._storage)
+                else:
+                    self._merge_file()
+                    self._save_snapshot(keyid, self._storage)
+                self._storage.saved()
+        except OSError as e:
+            raise DatabaseError(e)
+        self._hook_errors = self._run_hooks('post-save')
+
+    def _save_shards(self, keyid, storage):
+        if storage is self._storage:
+            self._merge_shards()
+        if storage is self._storage and storage.stat('manifest') is not None:
+            shards = sorted(self._dirty)
+        else:
+            # a new copy of the whole database
+            self._load_all()
+            storage.create(sharded=True)
+            jsondata = {'type': self._type,
+                        'version': self._version,
+                        'layout': 'sharded',
+                        'shards': self._nshards,
+                        'key': codecs.encode(self._shardkey, 'hex').decode('ascii')}
+            self._write(storage, 'manifest', jsondata, keyid)
+            shards = range(self._nshards)
+        for shard in shards:
+            jsondata = {'type': 'assword-shard',
+                        'version': self._version,
+                        'entries': {c: self._entries[c] for c in self._shards[shard]}}
+            self._write(storage, self._shardname(shard), jsondata, keyid)
+        if storage is self._storage:
+            self._dirty = set()
+
+    def record_use(self, context):
+        """Count a retrieval of the entry for context.
+
+        Uses are only counted in memory, and saved by the next save()
+        or save_usage(), so that retrievals can be counted without
+        writing anything at the time.
 
         """
-        mset = {}
-        for context, entry in self._entries.items():
-            # simple substring match
-            if query in context:
-                mset[context] = entry
-        return mset
+        usage.record(self._usage_pending, context)
 
+    def _read_usage(self):
+        self._stats['usage'] = self._storage.stat('usage')
+        if self._stats['usage'] is None:
+            return {}
+        return self._read('usage', 'assword-usage')['usage']
 
-############################################################
-    
-# Assumes that the func_data is set to the number of the text column in the
-# model.
-def _match_func(completion, key, iter, column):
-    model = completion.get_model()
-    text = model[iter][column]
-    if text.lower().find(key.lower()) > -1:
-        return True
-    return False
-
-class Gui:
-    """Assword X-based query UI."""
-    def __init__(self, db, query=None):
-
-        self.db = db
-        self.query = None
-        self.results = None
-        self.selected = None
-        self.window = None
-        self.entry = None
-        self.label = None
-
-        if query:
-            # If we have an intial query, directly do a search without
-            # initializing any X objects.  This will initialize the
-            # database and potentially return entries.
-            r = self.db.search(query)
-            # If only a single entry is found, _search() will set the
-            # result and attempt to close any X objects (of which
-            # there are none).  Since we don't need to initialize any
-            # GUI, return the initialization immediately.
-            # See .returnValue().
-            if len(r) == 1:
-                self.selected = r[list(r.keys())[0]]
-                return
+    @property
+    def usage(self):
+        """Dict of context to [use count, timestamp of last use].
+
+        Includes the uses recorded since the usage was last saved.
+        The saved usage is read on first access.
 
-        self.window = Gtk.Window(Gtk.WindowType.TOPLEVEL)
-        self.window.set_border_width(4)
-        windowicon = self.window.render_icon(Gtk.STOCK_DIALOG_AUTHENTICATION, Gtk.IconSize.DIALOG)
-        self.window.set_icon(windowicon)
-
-        self.entry = Gtk.Entry()
-        if query:
-            self.entry.set_text(query)
-        completion = Gtk.EntryCompletion()
-        self.entry.set_completion(completion)
-        liststore = Gtk.ListStore(GObject.TYPE_STRING)
-        completion.set_model(liststore)
-        completion.set_text_column(0)
-        completion.set_match_func(_match_func, 0) # 0 is column number
-        context_len = 50
-        for context in self.db:
-            if len(context) > context_len:
-                context_len = len(context)
-            liststore.append([context])
-        hbox = Gtk.HBox()
-        vbox = Gtk.VBox()
-        self.button = Gtk.Button("Create")
-        self.label = Gtk.Label(label="enter context for desired password:")
-        self.window.add(vbox)
-
-        if self.db.sigvalid is False:
-            notification = Gtk.Label()
-            msg = "WARNING: could not validate signature on db file"
-            notification.set_markup('<span foreground="red">%s</span>' % msg)
-            if len(msg) > context_len:
-                context_len = len(msg)
-            hsep = Gtk.HSeparator()
-            vbox.add(notification)
-            vbox.add(hsep)
-            notification.show()
-            hsep.show()
-
-        vbox.add(self.label)
-        vbox.pack_end(hbox, False, False, 0)
-        hbox.add(self.entry)
-        hbox.pack_end(self.button, False, False, 0)
-        self.entry.set_width_chars(context_len)
-        self.entry.connect("activate", self.retrieve)
-        self.entry.connect("changed", self.update_button)
-        self.button.connect("clicked", self.create)
-        self.window.connect("destroy", self.destroy)
-        self.window.connect("key-press-event", self.keypress)
-    
-        self.entry.show()
-        self.label.show()
-        vbox.show()
-        hbox.show()
-        self.button.show()
-        self.update_button(self.entry)
-        self.window.show()
-
-    def keypress(self, widget, event):
-        if event.keyval == Gdk.KEY_Escape:
-            Gtk.main_quit()
-
-    def update_button(self, widget, data=None):
-        e = self.entry.get_text()
-        self.button.set_sensitive(e != '' and e not in self.db)
-
-    def retrieve(self, widget, data=None):
-        e = self.entry.get_text()
-        if e in self.db:
-            self.selected = self.db[e]
-            if self.selected is None:
-                self.label.set_text("weird -- no context found even though we thought there should be one")
+        """
+        if self._usage is None:
+            if self._storage:
+                with self._storage.lock():
+                    self._usage = self._read_usage()
             else:
-                Gtk.main_quit()
+                self._usage = {}
+        return usage.merge(self._usage, self._usage_pending)
+
+    def usage_scores(self, now=None):
+        """Dict of context to ranking score (see assword.usage.scores())."""
+        return usage.scores(self.usage, now)
+
+    def save_usage(self, keyid=None):
+        """Save the uses recorded since the usage was last saved.
+
+        Only the usage blob is written, which is much cheaper than
+        save() for a large database.  Uses saved meanwhile by other
+        processes are kept.  Does nothing if no uses were recorded.
+
+        """
+        if not self._usage_pending:
+            return
+        if not keyid:
+            keyid = self._keyid
+        if not keyid:
+            raise DatabaseError('Key ID for decryption not specified.')
+        if not self._storage:
+            raise DatabaseError('Save path not specified.')
+        try:
+            with trace.span('save-usage', contexts=len(self._usage_pending)), \
+                 self._storage.lock(exclusive=True):
+                self._save_usage(keyid)
+        except OSError as e:
+            raise DatabaseError(e)
+
+    def _save_usage(self, keyid):
+        if self._usage is None or self._changed_on_disk('usage'):
+            self._usage = self._read_usage()
+        merged = usage.merge(self._usage, self._usage_pending)
+        jsondata = {'type': 'assword-usage',
+                    'version': self._version,
+                    'usage': merged}
+        self._write(self._storage, 'usage', jsondata, keyid)
+        self._usage = merged
+        self._usage_pending = {}
+
+    @property
+    def index(self):
+        """ContextIndex of database contexts.
+
+        The index is built on first use and kept up to date by add(),
+        replace() and remove().
+
+        """
+        if self._index is None:
+            self._load_all()
+            with trace.span('index', entries=len(self._entries)):
+                self._index = ContextIndex(self._entries)
+        return self._index
+
+    @property
+    def meta_index(self):
+        """MetaIndex of the hosts and tags of database entries.
+
+        As the index property, the index is built on first use and
+        kept up to date by add(), replace() and remove().
+
+        """
+        if self._meta_index is None:
+            self._load_all()
+            with trace.span('meta-index', entries=len(self._entries)):
+                self._meta_index = MetaIndex(self._entries)
+        return self._meta_index
+
+    def by_host(self, host):
+        """Sorted list of the contexts whose URLs are for host.
+
+        Contexts whose URLs are for a domain host is in are included
+        (see assword.index.MetaIndex.host()).
+
+        """
+        return sorted(self.meta_index.host(host))
+
+    def by_tag(self, tag):
+        """Sorted list of the contexts with tag."""
+        return sorted(self.meta_index.tag(tag))
+
+    def tags(self):
+        """Dict of each tag in the database to the number of its contexts."""
+        return self.meta_index.tags()
+
+    @contextlib.contextmanager
+    def transaction(self, keyid=None, path=None):
+        """Context manager grouping changes into a single save.
+
+        Changes made inside the with block are saved once, with
+        save(keyid, path), when the block completes.  If the block or
+        the save raises an exception, all changes made inside the
+        block are discarded and the exception is propagated.
+
+            with db.transaction():
+                db.add('foo')
+                db.remove('bar')
+
+        """
+        entries = dict(self._entries)
+        shards = {shard: set(contexts) for shard, contexts in self._shards.items()}
+        dirty = set(self._dirty)
+        changed = dict(self._changed)
+        stats = dict(self._stats)
+        try:
+            yield self
+            self.save(keyid, path)
+        except:
+            self._entries = entries
+            self._shards = shards
+            self._dirty = dirty
+            self._changed = changed
+            self._stats = stats
+            self._index = None
+            self._meta_index = None
+            raise
+
+    def itersearch(self, query=None, ignorecase=False, fuzzy=False, limit=None):
+        """Iterator of (context, entry) pairs matching query.
+
+        See search() for the arguments.  Substring matches are
+        produced as they are found.  Unless the index has already been
+        built (see the index property), they are found by scanning the
+        contexts, which is cheaper than building the index for a
+        one-off query.
+
+        """
+        self._load_all()
+        if fuzzy:
+            contexts = self.index.fuzzy(query, limit=limit)
+        elif self._index is not None:
+            contexts = self._index.itersearch(query, ignorecase=ignorecase, limit=limit)
         else:
-            self.label.set_text("no match")
+            contexts = scan(self._entries, query, ignorecase=ignorecase, limit=limit)
+        for context in contexts:
+            yield context, self._entries[context]
+
+    def search(self, query=None, ignorecase=False, fuzzy=False, limit=None):
+        """Search for query in contexts.
+
+        If query is None, all entries will be returned.  By default
+        contexts are matched by case-sensitive substring.  If
+        ignorecase is True matching is case-insensitive.  If fuzzy is
+        True, contexts containing the characters of query in order are
+        matched case-insensitively, best matches first.  At most limit
+        entries are returned if limit is not None.
+
+        """
+        # the query itself is not traced, as it says what the user
+        # was looking for
+        with trace.span('search', query_length=len(query or ''),
+                        fuzzy=fuzzy) as span:
+            results = dict(self.itersearch(query, ignorecase, fuzzy, limit))
+            span['results'] = len(results)
+        return results
 
-    def create(self, widget, data=None):
-        e = self.entry.get_text()
-        self.selected = self.db.add(e)
-        self.db.save()
-        Gtk.main_quit()
 
-    def destroy(self, widget, data=None):
-        Gtk.main_quit()
+############################################################
 
-    def returnValue(self):
-        if self.selected is None:
-            Gtk.main()
-        return self.selected
+def __getattr__(name):
+    # The GUI lives in its own module so that the database and
+    # command line interface can be used without loading GTK.  Keep
+    # assword.Gui working for existing callers by importing it on
+    # first access.
+    if name == 'Gui':
+        from .gui import Gui
+        return Gui
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -4,10 +4,12 @@ import os
 import sys
 import json
 import gpgme
+import itertools
+import getopt
 import getpass
-import subprocess
 
 import assword
+import assword.entry
 
 ############################################################
 
@@ -17,7 +19,7 @@ def version():
     print(assword.__version__)
 
 def usage():
-    print("Usage:", PROG, "<command> [<args>...]")
+    print("Usage:", PROG, "[--profile=FILE] <command> [<args>...]")
     print("""
 The password database is stored as a single json object, OpenPGP
 encrypted and signed, and written to local disk (see ASSWORD_DB).  The
@@ -26,45 +28,186 @@ entries are keyed by 'context'.  During retrieval of passwords, the
 database is decrypted and read into memory.  Contexts are search by
 sub-string match.
 
+Options:
+
+  --profile=FILE     Run the command under cProfile and write the profile
+                     statistics to FILE, for reading with the pstats module.
+
 Commands:
 
-  add [<context>]    Add a new entry.  If context is '-' read from stdin.
+  add [<options>] [<context>]
+                     Add a new entry.  If context is '-' read from stdin.
                      If not specified, user will be prompted for
                      context.  If the context already exists, an error
                      will be thrown.  See ASSWORD_PASSWORD for
-                     information on passwords.
+                     information on passwords.  Options:
+                       --policy=POLICY  generate the password according
+                                        to POLICY (see Password policies
+                                        below).
+                       --username=NAME  user name to store with the entry.
+                       --url=URL        URL to store with the entry.
+                       --tag=TAG        tag the entry; may be given more
+                                        than once.
 
-  replace [<context>]
+  replace [<options>] [<context>]
                      Replace password for existing entry.  If context
                      is '-' read from stdin.  If not specified, user
                      will be prompted for context.  If the context
                      does not exist an error will be thrown. See
                      ASSWORD_PASSWORD for information on passwords.
+                     Options are as for add.  The entry's user name,
+                     URL and tags are kept unless given; an empty
+                     value (e.g. --tag='') removes them.
 
-  dump [<string>]    Dump search results as json.  If string not specified all
+  dump [<options>] [<string>]
+                     Dump search results as json.  If string not specified all
                      entries are returned.  Passwords will not be displayed
-                     unless ASSWORD_DUMP_PASSWORDS is set.
+                     unless ASSWORD_DUMP_PASSWORDS is set.  Options:
+                       --format=FORMAT  'json' (default) for one indented
+                                        object sorted by context, 'compact'
+                                        for one single-line object, or
+                                        'jsonl' for one object per line with
+                                        the context in a 'context' field.
+                                        compact and jsonl output is written
+                                        as entries are found.
+                       --fields=FIELDS  comma-separated list of entry fields
+                                        to include (date, password, source,
+                                        username, url, tags).  source, the
+                                        database the entry is from, is
+                                        included by default when ASSWORD_DB
+                                        lists several databases, and
+                                        username, url and tags for the
+                                        entries that have them.
+                       --host=HOST      only entries whose URL is for HOST
+                                        or a domain it is in (e.g.
+                                        entries for example.com are
+                                        output for login.example.com).
+                       --tag=TAG        only entries tagged TAG.
+                       --limit=N        output at most N entries.
+                       --sort=ORDER     'context' to output entries sorted
+                                        by context, or 'usage' to output
+                                        the entries retrieved most often
+                                        and most recently with 'assword
+                                        gui' first.  By default entries
+                                        are output as they are found.
 
   gui [<string>]     GUI interface, good for X11 window manager integration.
-                     Upon invocation the user will be prompted to decrypt the
-                     database, after which a graphical search prompt will be
-                     presented.  If an additional string is provided, it will
-                     be added as the initial search string.  All matching results
+                     Upon invocation a graphical search prompt is presented
+                     at once, while the database is decrypted (the user may
+                     be prompted for the passphrase); what is typed meanwhile
+                     is searched for when decryption completes.  If an
+                     additional string is provided, it will be added as the
+                     initial search string.  All matching results
                      for the query will be presented to the user.  When a result
                      is selected, the password will be retrieved according to the
                      method specified by ASSWORD_XPASTE.  If no match is found,
                      the user has the opportunity to generate and store a new
                      password, which is then delivered via ASSWORD_XPASTE.
+                     If a resident GUI is running, it is shown instead.
+                     Completions are ranked by how often and how recently
+                     their entries have been retrieved, which is recorded
+                     in an encrypted file next to the database
+                     (ASSWORD_DB.usage); moving past the last completion
+                     fetches more.
+
+  gui --daemon [stop|status|lock]
+                     Run a resident GUI, which keeps its window built and
+                     hidden, decrypts the database on startup, and shows
+                     the window when 'assword gui' is run, or at once when
+                     sent SIGUSR1 (e.g. bound to a hotkey with
+                     'pkill -USR1 -f "assword gui --daemon"').  The
+                     database is dropped from memory ASSWORD_GUI_TIMEOUT
+                     seconds after a retrieval, and decrypted again when
+                     the window is next shown.  'stop' stops a running
+                     resident GUI, 'status' reports on it, and 'lock'
+                     drops its database now.
 
   remove <context>   Delete an entry from the database.
 
+  batch              Apply a stream of changes read from stdin as JSON
+                     lines, one operation per line, e.g.:
+                       {"op": "add", "context": "foo@bar"}
+                       {"op": "replace", "context": "baz", "password": "s3cr3t"}
+                       {"op": "remove", "context": "qux"}
+                     For add and replace, "username", "url" and "tags"
+                     (a list) are as the options of add and replace, and
+                     "password" may be a string, or an int giving the
+                     number of random bytes; if omitted a
+                     password is generated, according to "policy" if that
+                     is given (see Password policies below).  The database is saved once
+                     after all operations succeed.  If any operation fails
+                     no changes are written.
+
+  import [<options>] [<file>]
+                     Import entries from a file exported by another
+                     password manager or a web browser, or from stdin if
+                     file is '-' or not specified.  New contexts are
+                     added; contexts already in the database with a
+                     different password are reported as conflicts and
+                     left alone.  Entries are read as they are imported,
+                     and the database is saved once at the end.  Options:
+                       --format=FORMAT  'csv' with a header line naming
+                                        'context' and 'password' columns,
+                                        or the 'url', 'username' and
+                                        'password' columns of Firefox and
+                                        Chromium login exports (imported
+                                        as username@host); or 'jsonl',
+                                        objects with 'context' and
+                                        'password', one per line.  The
+                                        default is from the file name
+                                        extension, or csv.
+                       --replace        replace conflicting entries.
+                       --dry-run        report what would be imported
+                                        without writing any changes.
+
+  compact            Rewrite the database file with the changes recorded in
+                     its journal (see ASSWORD_JOURNAL), and remove the
+                     journal.
+
+  agent [stop|status]
+                     Run a resident agent that decrypts the database once
+                     and serves requests from other assword commands over a
+                     per-user unix socket (see ASSWORD_AGENT_SOCKET).  The
+                     agent runs in the foreground and exits after
+                     ASSWORD_AGENT_TIMEOUT seconds without requests.  Other
+                     commands use the agent if it is running and fall back
+                     to decrypting the database directly if not.  'stop'
+                     stops a running agent and 'status' reports on it.
+
   version            Report the version of this program.
 
   help               This help.
 
+Password policies:
+
+  A policy is either the name of a policy in the ASSWORD_POLICIES file,
+  or a comma-separated list of settings:
+    length=N                  exact password length (default %d)
+    classes=CLASS+CLASS...    character classes to draw from: lower,
+                              upper, digits, symbols (default
+                              lower+upper+digits)
+    require=CLASS+CLASS...    classes each password must contain a
+                              character of (default all of classes)
+    alphabet=CHARS            characters to draw from instead of
+                              classes; must come last
+  e.g. 'length=6,classes=digits' or 'length=16,alphabet=abc123'.
+
 Environment:
 
-  ASSWORD_DB        Path to assword database file.  Default: ~/.assword/db
+  ASSWORD_DB        Path to assword database file, or directory for a
+                    sharded database.  Default: ~/.assword/db
+                    Several databases may be given separated by ':'.
+                    dump and gui then search all of them, decrypted in
+                    parallel, and report which database each entry is
+                    from; where databases share a context the entry of
+                    the first is used.  All changes are made to the
+                    first database, the primary, and the other settings
+                    below only apply to it.
+
+  ASSWORD_SHARDS    If set when a new database is created, the database is
+                    created as a directory of this many separately
+                    encrypted shards, so that changing an entry only
+                    rewrites the shard that holds it.
 
   ASSWORD_KEYFILE   File containing OpenPGP key ID of database encryption
                     recipient.  Default: ~/.assword/keyid
@@ -75,47 +218,254 @@ Environment:
   ASSWORD_PASSWORD  For new entries, entropy of auto-generated password
                     in bytes (actual generated password will be longer
                     due to base64 encoding). If set to 'prompt' user
-                    will be prompted for for password.  Default: %d
+                    will be prompted for for password.  Anything else
+                    is taken as a password policy.  Default: %d
+
+  ASSWORD_POLICIES  JSON file of named password policies, e.g.:
+                      {"pin": {"length": 6, "classes": ["digits"],
+                               "match": ["*bank*"]}}
+                    with the settings described under Password policies.
+                    Passwords generated for contexts matching one of the
+                    shell patterns in "match" of a policy follow the
+                    first such policy, unless another policy or
+                    ASSWORD_PASSWORD is given.
+                    Default: ~/.assword/policies
 
   ASSWORD_DUMP_PASSWORDS Include passwords in dump when set.
 
   ASSWORD_XPASTE    Method for password retrieval.  Options are: 'xdo', which
                     attempts to type the password into the window that had
-                    focus on launch, or 'xclip' which inserts the password in
-                    the X clipboard.  Default: xdo
-"""%(assword.DEFAULT_NEW_PASSWORD_OCTETS))
+                    focus on launch, 'clipboard' which puts the password in
+                    the X clipboard, or 'xclip' which puts it in the X
+                    primary selection.  A password in the clipboard or
+                    primary selection is cleared after
+                    ASSWORD_CLIPBOARD_TIMEOUT seconds, which 'assword gui'
+                    keeps running for.  'MODULE:NAME' loads the method
+                    NAME from python module MODULE (see assword.paste).
+                    Default: xdo
+
+  ASSWORD_XDO_SENDEVENT ':'-separated list of shell patterns of window
+                    names.  With the 'xdo' method, the password is sent
+                    to windows whose names match with XSendEvent, without
+                    focusing them, rather than typed into the X session.
+                    Some applications ignore such input.
+
+  ASSWORD_CLIPBOARD_TIMEOUT Seconds after which a password put in an X
+                    selection is cleared.  Default: 45
+
+  ASSWORD_COMPRESS  If set to '1' the database is compressed before it is
+                    encrypted when saved, if set to '0' it is not.  If
+                    not set the existing database's setting is kept.
+                    When an agent is running this is taken from the
+                    agent's environment.
+
+  ASSWORD_JOURNAL   If set to '1', changes are saved by appending them to an
+                    encrypted journal next to the database file
+                    (ASSWORD_DB.journal) rather than rewriting the whole
+                    database.  The journal is compacted into the database
+                    once it grows past %d bytes, or by 'assword compact'.
+                    If set to '0' the database file is rewritten on every
+                    save.  If not set, the journal is used if one exists.
+
+  ASSWORD_STORAGE   How the database is stored: 'file', a file (or directory
+                    for a sharded database) at ASSWORD_DB, or 'git', the
+                    same with every save committed to a git repository
+                    in the directory holding the database (created if
+                    needed).  Default: file
+
+  ASSWORD_HOOKS     Directory of hook programs, run with ASSWORD_DB set:
+                    'pre-open' is run, and waited for, before the
+                    database is read (e.g. to fetch it from a remote
+                    repository), and 'post-save' is started in the
+                    background after each save and not waited for
+                    (e.g. to push it).  Hooks that are missing or not
+                    executable are skipped.  Default: ~/.assword/hooks
+
+  ASSWORD_TRACE     If set, the time taken by each phase of the command
+                    (finding the key, decryption, parsing, searching,
+                    building the GUI, encoding, encryption, writing) is
+                    written to this file as JSON when the command exits,
+                    with sizes and entry counts.  Contexts, queries and
+                    passwords are not recorded.
+
+  ASSWORD_AGENT_SOCKET Path to the agent socket.  If set to the empty string
+                    the agent will not be used.
+                    Default: $XDG_RUNTIME_DIR/assword/agent
+
+  ASSWORD_AGENT_TIMEOUT Idle timeout of the agent in seconds.  Default: %d
+
+  ASSWORD_GUI_SOCKET Path to the socket of the resident GUI.  If set to the
+                    empty string the resident GUI will not be used.
+                    Default: $XDG_RUNTIME_DIR/assword/gui
+
+  ASSWORD_GUI_TIMEOUT Seconds after a retrieval after which the resident
+                    GUI drops the database from memory.  Default: %d
+"""%(assword.policy.DEFAULT_LENGTH, assword.DEFAULT_NEW_PASSWORD_OCTETS,
+    assword.DEFAULT_JOURNAL_LIMIT, DEFAULT_AGENT_TIMEOUT, DEFAULT_GUI_TIMEOUT))
 
 ############################################################
 
 ASSWORD_DIR = os.path.join(os.path.expanduser('~'),'.assword')
 
-DBPATH = os.getenv('ASSWORD_DB', os.path.join(ASSWORD_DIR, 'db'))
+DBPATHS = os.getenv('ASSWORD_DB', os.path.join(ASSWORD_DIR, 'db')).split(':')
 
-############################################################
+# the primary database, which all changes are made to
+DBPATH = DBPATHS[0]
+
+HOOKSDIR = os.getenv('ASSWORD_HOOKS', os.path.join(ASSWORD_DIR, 'hooks'))
+
+POLICIES = os.getenv('ASSWORD_POLICIES', os.path.join(ASSWORD_DIR, 'policies'))
+
+# keep in sync with assword.agent.DEFAULT_IDLE_TIMEOUT; the agent
+# module is only imported when an agent is in use
+DEFAULT_AGENT_TIMEOUT = 900
+
+# keep in sync with assword.gui.DEFAULT_LOCK_TIMEOUT; GTK is only
+# loaded for the GUI
+DEFAULT_GUI_TIMEOUT = 300
 
-def xclip(text):
-    p = subprocess.Popen(' '.join(["xclip", "-i"]),
-                         shell=True,
-                         stdin=subprocess.PIPE)
-    p.communicate(text.encode('utf-8'))
+def agent_socket():
+    path = os.getenv('ASSWORD_AGENT_SOCKET')
+    if path is not None:
+        return path
+    rundir = os.getenv('XDG_RUNTIME_DIR')
+    if rundir:
+        return os.path.join(rundir, 'assword', 'agent')
+    return os.path.join('/tmp', 'assword-%d' % os.getuid(), 'agent')
+
+def gui_socket():
+    path = os.getenv('ASSWORD_GUI_SOCKET')
+    if path is not None:
+        return path
+    rundir = os.getenv('XDG_RUNTIME_DIR')
+    if rundir:
+        return os.path.join(rundir, 'assword', 'gui')
+    return os.path.join('/tmp', 'assword-%d' % os.getuid(), 'gui')
 
 ############################################################
+
 # Return codes:
 # 1 command/load line error
 # 10 db error
 # 20 gpg/key error
 ############################################################
 
+def open_agent_db(keyid=None):
+    sock = agent_socket()
+    if not sock or not os.path.exists(sock):
+        return None
+    from assword.agent import AgentDatabase, AgentError
+    try:
+        return AgentDatabase(DBPATH, keyid, sock)
+    except (OSError, AgentError):
+        return None
+
+def env_flag(var):
+    value = os.getenv(var)
+    if not value:
+        return None
+    if value not in ('0', '1'):
+        sys.exit("%s environment variable must be '0' or '1'." % var)
+    return value == '1'
+
+def db_shards():
+    shards = os.getenv('ASSWORD_SHARDS')
+    if not shards:
+        return None
+    try:
+        shards = int(shards)
+    except ValueError:
+        sys.exit("ASSWORD_SHARDS environment variable is not an int.")
+    if shards < 1:
+        sys.exit("ASSWORD_SHARDS environment variable must be positive.")
+    return shards
+
+def db_storage():
+    storage = os.getenv('ASSWORD_STORAGE', 'file')
+    if storage == 'file':
+        return assword.storage.FileStorage(DBPATH)
+    if storage == 'git':
+        return assword.storage.GitStorage(DBPATH)
+    sys.exit("Unknown ASSWORD_STORAGE: %s" % storage)
+
+def db_hooks():
+    hooks = {}
+    for point, background in [('pre-open', False), ('post-save', True)]:
+        path = os.path.join(HOOKSDIR, point)
+        if os.access(path, os.X_OK):
+            hooks[point] = [assword.storage.CommandHook([path], background=background)]
+    return hooks
+
+def db_options():
+    """Database keyword arguments set in the environment."""
+    return {'compress': env_flag('ASSWORD_COMPRESS'),
+            'shards': db_shards(),
+            'journal': env_flag('ASSWORD_JOURNAL'),
+            'storage': db_storage(),
+            'hooks': db_hooks()}
+
+# ids of the databases whose bad signatures have been reported
+_SIG_WARNED = set()
+
+def warn_sigvalid(db):
+    """Warn, once per database, of signatures that could not be validated.
+
+    The shards of a sharded database are verified as they are loaded,
+    so this is called again once a command has used the database.
+
+    """
+    for d in getattr(db, 'databases', [db]):
+        if d.sigvalid is not False or id(d) in _SIG_WARNED:
+            continue
+        _SIG_WARNED.add(id(d))
+        if d.path == DBPATH:
+            print("WARNING: could not validate OpenPGP signature on db file.", file=sys.stderr)
+        else:
+            print("WARNING: could not validate OpenPGP signature on db file %s." % d.path,
+                  file=sys.stderr)
+
+def warn_hook_errors(db):
+    # a failing post-save hook does not undo the save
+    for error in db.hook_errors:
+        print("WARNING: %s" % error, file=sys.stderr)
+
 def open_db(keyid=None):
     try:
-        db = assword.Database(DBPATH, keyid)
+        db = open_agent_db(keyid)
+        if db is None:
+            db = assword.Database(DBPATH, keyid, **db_options())
     except assword.DatabaseError as e:
         print('Assword database error: %s' % e.msg, file=sys.stderr)
         sys.exit(10)
-    if db.sigvalid is False:
-        print("WARNING: could not validate OpenPGP signature on db file.", file=sys.stderr)
+    warn_sigvalid(db)
+    if db.journal_truncated:
+        print("WARNING: ignored a partly written record at the end of the db journal.",
+              file=sys.stderr)
     return db
 
+def open_secondary_db(path, keyid=None):
+    # each database has its own gpgme context, so that they can be
+    # decrypted at the same time
+    try:
+        db = assword.Database(path, keyid, crypto=assword.crypto.Crypto())
+    except assword.DatabaseError as e:
+        print('Assword database error: %s: %s' % (path, e.msg), file=sys.stderr)
+        sys.exit(10)
+    warn_sigvalid(db)
+    if db.journal_truncated:
+        print("WARNING: ignored a partly written record at the end of the db journal %s."
+              % path, file=sys.stderr)
+    return db
+
+def open_dbs(keyid=None):
+    """Open all of the databases, as a Federation if there are several."""
+    if len(DBPATHS) == 1:
+        return open_db(keyid)
+    openers = [lambda: open_db(keyid)]
+    for path in DBPATHS[1:]:
+        openers.append(lambda path=path: open_secondary_db(path, keyid))
+    return assword.Federation(assword.federation.open_all(openers))
+
 def get_keyid():
     keyid = os.getenv('ASSWORD_KEYID')
     keyfile = os.getenv('ASSWORD_KEYFILE', os.path.join(ASSWORD_DIR, 'keyid'))
@@ -138,9 +488,10 @@ def get_keyid():
     if not keyid:
         sys.exit(20)
 
+    # the key is cached for the database to use
     try:
-        gpg = gpgme.Context()
-        gpg.get_key(keyid)
+        with assword.trace.span('get-key'):
+            assword.crypto.default_crypto().get_key(keyid)
     except gpgme.GpgmeError as e:
         print("GPGME error for key ID %s:" % keyid, file=sys.stderr)
         print("  %s" % e, file=sys.stderr)
@@ -171,15 +522,81 @@ def retrieve_context(args):
         sys.exit("Can not add empty string context.")
     return context
 
-def retrieve_password():
+_policies = None
+_policy_cache = {}
+
+# The policy functions raise assword.PolicyError, which commands
+# report with policy_error().
+
+def named_policies():
+    global _policies
+    if _policies is None:
+        _policies = assword.policy.load_policies(POLICIES)
+    return _policies
+
+def get_policy(spec):
+    """Policy for a policy name or spec, the same one each time.
+
+    Reusing the Policy lets it reuse its buffer of random bytes.
+
+    """
+    if spec not in _policy_cache:
+        policies = named_policies()
+        if spec in policies:
+            _policy_cache[spec] = policies[spec][0]
+        else:
+            _policy_cache[spec] = assword.Policy.parse(spec)
+    return _policy_cache[spec]
+
+def context_policy(context):
+    """Policy from the policies file matching context, or None."""
+    return assword.policy.select(named_policies(), context)
+
+def policy_error(e):
+    print('Assword policy error: %s' % e.msg, file=sys.stderr)
+    sys.exit(1)
+
+def context_options(args):
+    """Policy, entry fields and remaining arguments of add and replace."""
+    try:
+        opts, args = getopt.gnu_getopt(args, '', ['policy=', 'username=', 'url=', 'tag='])
+    except getopt.GetoptError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    policy = None
+    meta = {}
+    for opt, val in opts:
+        if opt == '--policy':
+            try:
+                policy = get_policy(val)
+            except assword.PolicyError as e:
+                policy_error(e)
+        elif opt in ['--username', '--url']:
+            meta[opt[2:]] = val
+        elif opt == '--tag':
+            # an empty tag leaves the list empty, removing the tags
+            tags = meta.setdefault('tags', [])
+            if val:
+                tags.append(val)
+    return policy, meta, args
+
+def retrieve_password(context, policy=None):
+    if policy is not None:
+        return policy
     # get password from prompt if requested
     if os.getenv('ASSWORD_PASSWORD') is None:
-        return None
+        try:
+            return context_policy(context)
+        except assword.PolicyError as e:
+            policy_error(e)
     elif os.getenv('ASSWORD_PASSWORD') != 'prompt':
         try:
             octets = int(os.getenv('ASSWORD_PASSWORD'))
         except ValueError:
-            sys.exit("ASSWORD_PASSWORD environment variable is neither int or 'prompt'.")
+            try:
+                return get_policy(os.getenv('ASSWORD_PASSWORD'))
+            except assword.PolicyError as e:
+                policy_error(e)
         print("Auto-generating password...", file=sys.stderr)
         return octets
     try:
@@ -197,87 +614,289 @@ def retrieve_password():
 # Add a password to the database.
 # First argument is potentially a context.
 def add(args):
+    policy, meta, args = context_options(args)
     keyid = get_keyid()
     context = retrieve_context(args)
     db = open_db(keyid)
     if context in db:
         print("Entry already exists with context: '%s'" % (context), file=sys.stderr)
         sys.exit(1)
-    password = retrieve_password()
+    warn_sigvalid(db)
+    password = retrieve_password(context.strip(), policy)
     try:
-        db.add(context.strip(), password)
+        db.add(context.strip(), password, **meta)
         db.save()
     except assword.DatabaseError as e:
         print('Assword database error: %s' % e.msg, file=sys.stderr)
         sys.exit(10)
+    warn_hook_errors(db)
     print("New entry writen.", file=sys.stderr)
 
 # Replace a password in the database.
 # First argument is context to replace.
 def replace(args):
+    policy, meta, args = context_options(args)
     keyid = get_keyid()
     context = retrieve_context(args)
     db = open_db(keyid)
     if context not in db:
         print("Context not found: '%s'" % (context), file=sys.stderr)
         sys.exit(1)
-    password = retrieve_password()
+    warn_sigvalid(db)
+    password = retrieve_password(context.strip(), policy)
     try:
-        db.replace(context.strip(), password)
+        db.replace(context.strip(), password, **meta)
         db.save()
     except assword.DatabaseError as e:
         print('Assword database error: %s' % e.msg, file=sys.stderr)
         sys.exit(10)
+    warn_hook_errors(db)
     print("New entry writen.", file=sys.stderr)
 
+DUMP_FORMATS = ['json', 'compact', 'jsonl']
+DUMP_FIELDS = ['date', 'password', 'source'] + list(assword.entry.META_FIELDS)
+DUMP_SORTS = ['context', 'usage']
+
+def dump_record(db, context, entry, fields):
+    record = {}
+    for f in fields:
+        if f == 'source':
+            if len(DBPATHS) > 1:
+                record[f] = db.source(context).path
+            else:
+                record[f] = DBPATH
+        elif f in entry:
+            record[f] = entry[f]
+    return record
+
+def dump_filter(db, results, host=None, tag=None):
+    """The results whose entries are for host and have tag."""
+    contexts = None
+    if host is not None:
+        contexts = set(db.by_host(host))
+    if tag is not None:
+        tagged = set(db.by_tag(tag))
+        contexts = tagged if contexts is None else contexts & tagged
+    return ((context, entry) for context, entry in results if context in contexts)
+
 def dump(args):
+    try:
+        opts, args = getopt.gnu_getopt(args, '', ['format=', 'fields=', 'limit=', 'sort=',
+                                                  'host=', 'tag='])
+    except getopt.GetoptError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    fmt = 'json'
+    fields = None
+    limit = None
+    sort = None
+    host = None
+    tag = None
+    for opt, val in opts:
+        if opt == '--format':
+            if val not in DUMP_FORMATS:
+                print("Unknown dump format: %s" % val, file=sys.stderr)
+                sys.exit(1)
+            fmt = val
+        elif opt == '--fields':
+            fields = [f for f in val.split(',') if f]
+            for f in fields:
+                if f not in DUMP_FIELDS:
+                    print("Unknown dump field: %s" % f, file=sys.stderr)
+                    sys.exit(1)
+        elif opt == '--limit':
+            try:
+                limit = int(val)
+            except ValueError:
+                limit = -1
+            if limit < 0:
+                print("Dump limit must be a non-negative int.", file=sys.stderr)
+                sys.exit(1)
+        elif opt == '--sort':
+            if val not in DUMP_SORTS:
+                print("Unknown dump sort: %s" % val, file=sys.stderr)
+                sys.exit(1)
+            sort = val
+        elif opt == '--host':
+            host = val
+        elif opt == '--tag':
+            tag = val
+    if fields is None:
+        fields = ['date']
+        if os.getenv('ASSWORD_DUMP_PASSWORDS'):
+            fields.append('password')
+        if len(DBPATHS) > 1:
+            fields.append('source')
+        # output only for the entries that have them
+        fields.extend(assword.entry.META_FIELDS)
+    elif 'password' in fields and not os.getenv('ASSWORD_DUMP_PASSWORDS'):
+        print("Passwords are only dumped if ASSWORD_DUMP_PASSWORDS is set.", file=sys.stderr)
+        sys.exit(1)
     query = ' '.join(args)
-    if not os.path.exists(DBPATH):
+    if not any(os.path.exists(path) for path in DBPATHS):
         print("""Assword database does not exist.
 To add an entry to the database use 'assword add'.
 See 'assword help' for more information.""", file=sys.stderr)
         sys.exit(10)
-    db = open_db()
-    results = db.search(query)
-    output = {}
-    for context in results:
-        output[context] = {}
-        output[context]['date'] = results[context]['date']
-        if os.getenv('ASSWORD_DUMP_PASSWORDS'):
-            output[context]['password'] = results[context]['password']
-    print(json.dumps(output, sort_keys=True, indent=2))
+    db = open_dbs()
+    filtered = host is not None or tag is not None
+    if sort is None and not filtered:
+        results = db.itersearch(query, limit=limit)
+    else:
+        results = db.itersearch(query)
+    if filtered:
+        try:
+            results = dump_filter(db, results, host, tag)
+        except assword.DatabaseError as e:
+            print('Assword database error: %s' % e.msg, file=sys.stderr)
+            sys.exit(10)
+    if sort is not None:
+        if sort == 'usage':
+            try:
+                scores = db.usage_scores()
+            except assword.DatabaseError as e:
+                print('Assword database error: %s' % e.msg, file=sys.stderr)
+                sys.exit(10)
+            key = lambda r: (-scores.get(r[0], 0), r[0])
+        else:
+            key = lambda r: r[0]
+        results = sorted(results, key=key)[:limit]
+    elif filtered:
+        results = itertools.islice(results, limit)
+    if fmt == 'json':
+        output = {}
+        for context, entry in results:
+            output[context] = dump_record(db, context, entry, fields)
+        warn_sigvalid(db)
+        print(json.dumps(output, sort_keys=(sort != 'usage'), indent=2))
+        return
+    out = sys.stdout
+    separators = (',', ':')
+    if fmt == 'compact':
+        sep = ''
+        out.write('{')
+        for context, entry in results:
+            out.write('%s%s:%s' % (sep, json.dumps(context),
+                                   json.dumps(dump_record(db, context, entry, fields),
+                                              separators=separators)))
+            sep = ','
+        out.write('}\n')
+    elif fmt == 'jsonl':
+        for context, entry in results:
+            record = {'context': context}
+            record.update(dump_record(db, context, entry, fields))
+            out.write(json.dumps(record, separators=separators) + '\n')
+    # the entries have been output as they were found
+    out.flush()
+    warn_sigvalid(db)
 
 # The X GUI
+def get_paste(method):
+    # GTK is only loaded for the GUI
+    import assword.paste
+    sendevent = [p for p in os.getenv('ASSWORD_XDO_SENDEVENT', '').split(':') if p]
+    try:
+        timeout = int(os.getenv('ASSWORD_CLIPBOARD_TIMEOUT',
+                                assword.paste.DEFAULT_CLEAR_TIMEOUT))
+    except ValueError:
+        sys.exit("ASSWORD_CLIPBOARD_TIMEOUT environment variable is not an int.")
+    try:
+        return assword.paste.get(method, sendevent=sendevent, timeout=timeout)
+    except assword.paste.PasteError as e:
+        print('Assword paste error: %s' % e.msg, file=sys.stderr)
+        sys.exit(1)
+
+def show_resident_gui(query):
+    # True if a resident GUI is running and was asked to show itself
+    sock = gui_socket()
+    if not sock or not os.path.exists(sock):
+        return False
+    from assword.agent import AgentClient, AgentError
+    try:
+        AgentClient(sock).request('show', query=query)
+    except (OSError, AgentError):
+        return False
+    return True
+
 def gui(args, method='xdo'):
+    if args and args[0] == '--daemon':
+        gui_daemon(args[1:], method)
+        return
     query = ' '.join(args)
-    if method == 'xdo':
+    if show_resident_gui(query):
+        return
+    paste = get_paste(method)
+    target = paste.target()
+    from assword.gui import Gui
+    # do it
+    keyid = get_keyid()
+    # the window is shown while the database is decrypted
+    with assword.trace.span('gui-build'):
+        g = Gui(query=query, opener=lambda: open_dbs(keyid))
+    with assword.trace.span('gui-wait'):
+        try:
+            result = g.returnValue()
+        finally:
+            g.close()
+    if result:
+        with assword.trace.span('paste', method=method):
+            paste.deliver(result['password'], target)
+    # a newly created entry is saved while the password is delivered
+    if g.saving is not None:
+        try:
+            g.saving.result()
+        except assword.DatabaseError as e:
+            print('Assword database error: %s' % e.msg, file=sys.stderr)
+            sys.exit(10)
+        warn_hook_errors(g.db)
+    # the use is saved once the password has been delivered
+    if g.db is not None:
         try:
-            import xdo
-        except:
-            print("The xdo module is not found, so the 'xdo' paste method is not available.", file=sys.stderr)
-            print("Please install python3-xdo.", file=sys.stderr)
+            g.db.save_usage()
+        except assword.DatabaseError as e:
+            print('Assword database error: %s' % e.msg, file=sys.stderr)
+            sys.exit(10)
+    # serve a password put in an X selection until it is cleared
+    paste.wait()
+
+def gui_daemon(args, method='xdo'):
+    from assword.agent import AgentClient, AgentError
+    sock = gui_socket()
+    if not sock:
+        print("Resident GUI disabled (ASSWORD_GUI_SOCKET is empty).", file=sys.stderr)
+        sys.exit(1)
+    cmd = args[0] if args else 'start'
+    if cmd in ['stop', 'status', 'lock']:
+        try:
+            result = AgentClient(sock).request(cmd)
+        except (OSError, AgentError):
+            print("No resident GUI running at %s." % sock, file=sys.stderr)
             sys.exit(1)
-        # initialize xdo
-        x = xdo.xdo()
-        # get the id of the currently focused window
-        win = x.get_focused_window()
-    elif method == 'xclip':
-        pass
-    else:
-        print("Unknown X paste method:", method, file=sys.stderr)
+        if cmd == 'status':
+            print(json.dumps(result, sort_keys=True, indent=2))
+        return
+    elif cmd != 'start':
+        print("Unknown gui --daemon command:", cmd, file=sys.stderr)
         sys.exit(1)
-    # do it
+    try:
+        timeout = int(os.getenv('ASSWORD_GUI_TIMEOUT', DEFAULT_GUI_TIMEOUT))
+    except ValueError:
+        sys.exit("ASSWORD_GUI_TIMEOUT environment variable is not an int.")
+    paste = get_paste(method)
+    from assword.gui import ResidentGui
     keyid = get_keyid()
-    db = open_db(keyid)
-    result = assword.Gui(db, query=query).returnValue()
-    # type the password in the saved window
-    if result:
-        if method == 'xdo':
-            x.focus_window(win)
-            x.wait_for_window_focus(win)
-            x.type(result['password'])
-        elif method == 'xclip':
-            xclip(result['password'])
+    def deliver(entry, target):
+        with assword.trace.span('paste', method=method):
+            paste.deliver(entry['password'], target)
+    g = ResidentGui(lambda: open_dbs(keyid), deliver, target=paste.target,
+                    lock_timeout=timeout)
+    try:
+        g.listen(sock)
+    except AgentError as e:
+        print('Assword agent error: %s' % e.msg, file=sys.stderr)
+        sys.exit(1)
+    print("Resident GUI listening on %s." % sock, file=sys.stderr)
+    g.serve()
 
 def remove(args):
     keyid = get_keyid()
@@ -290,6 +909,7 @@ def remove(args):
     if context not in db:
         print("No entry with context: '%s'" % (context), file=sys.stderr)
         sys.exit(1)
+    warn_sigvalid(db)
     try:
         print("Really remove entry '%s'?" % (context), file=sys.stderr)
         response = input("Type 'yes' to remove: ")
@@ -303,31 +923,211 @@ def remove(args):
     except assword.DatabaseError as e:
         print('Assword database error: %s' % e.msg, file=sys.stderr)
         sys.exit(10)
+    warn_hook_errors(db)
     print("Entry removed.", file=sys.stderr)
 
-############################################################
-# main
+def compact(args):
+    keyid = get_keyid()
+    if not os.path.exists(DBPATH):
+        print("Assword database does not exist.", file=sys.stderr)
+        sys.exit(10)
+    # a running agent notices the rewritten file and reloads it
+    try:
+        db = assword.Database(DBPATH, keyid, **db_options())
+        db.compact()
+    except assword.DatabaseError as e:
+        print('Assword database error: %s' % e.msg, file=sys.stderr)
+        sys.exit(10)
+    warn_hook_errors(db)
+    print("Database compacted.", file=sys.stderr)
 
-def main():
-    if len(sys.argv) < 2:
-        print("Command not specified.", file=sys.stderr)
-        print(file=sys.stderr)
-        usage()
+def agent(args):
+    from assword.agent import Agent, AgentClient, AgentError
+    sock = agent_socket()
+    if not sock:
+        print("Agent disabled (ASSWORD_AGENT_SOCKET is empty).", file=sys.stderr)
+        sys.exit(1)
+    cmd = args[0] if args else 'start'
+    if cmd in ['stop', 'status']:
+        try:
+            result = AgentClient(sock).request(cmd)
+        except (OSError, AgentError):
+            print("No agent running at %s." % sock, file=sys.stderr)
+            sys.exit(1)
+        if cmd == 'status':
+            print(json.dumps(result, sort_keys=True, indent=2))
+        return
+    elif cmd != 'start':
+        print("Unknown agent command:", cmd, file=sys.stderr)
+        sys.exit(1)
+    try:
+        timeout = int(os.getenv('ASSWORD_AGENT_TIMEOUT', DEFAULT_AGENT_TIMEOUT))
+    except ValueError:
+        sys.exit("ASSWORD_AGENT_TIMEOUT environment variable is not an int.")
+    keyid = get_keyid()
+    try:
+        a = Agent(DBPATH, keyid, path=sock, timeout=timeout,
+                  **db_options())
+    except assword.DatabaseError as e:
+        print('Assword database error: %s' % e.msg, file=sys.stderr)
+        sys.exit(10)
+    print("Agent listening on %s." % sock, file=sys.stderr)
+    try:
+        a.serve()
+    except AgentError as e:
+        print('Assword agent error: %s' % e.msg, file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+def _batch_op(db, op):
+    if not isinstance(op, dict) or 'op' not in op or 'context' not in op:
+        raise assword.DatabaseError("operation must be an object with 'op' and 'context'")
+    context = op['context']
+    if not isinstance(context, str) or context == '':
+        raise assword.DatabaseError("context must be a non-empty string")
+    if not isinstance(op.get('password'), (str, int, type(None))):
+        raise assword.DatabaseError("password must be a string or an int")
+    password = op.get('password')
+    try:
+        if 'policy' in op:
+            if password is not None:
+                raise assword.DatabaseError("only one of password and policy may be given")
+            if not isinstance(op['policy'], str):
+                raise assword.DatabaseError("policy must be a string")
+            password = get_policy(op['policy'])
+        elif password is None:
+            password = context_policy(context)
+    except assword.PolicyError as e:
+        raise assword.DatabaseError(e.msg)
+    meta = {f: op[f] for f in assword.entry.META_FIELDS if f in op}
+    if op['op'] == 'add':
+        db.add(context, password, **meta)
+    elif op['op'] == 'replace':
+        db.replace(context, password, **meta)
+    elif op['op'] == 'remove':
+        if context not in db:
+            raise assword.DatabaseError("No entry with context: '%s'" % context)
+        db.remove(context)
+    else:
+        raise assword.DatabaseError("Unknown operation: %s" % op['op'])
+
+def batch(args):
+    keyid = get_keyid()
+    db = open_db(keyid)
+    count = 0
+    try:
+        with db.transaction():
+            for lineno, line in enumerate(sys.stdin, 1):
+                if line.strip() == '':
+                    continue
+                try:
+                    _batch_op(db, json.loads(line))
+                except ValueError as e:
+                    raise assword.DatabaseError('line %d: invalid JSON: %s' % (lineno, e))
+                except assword.DatabaseError as e:
+                    raise assword.DatabaseError('line %d: %s' % (lineno, e.msg))
+                count += 1
+    except assword.DatabaseError as e:
+        warn_sigvalid(db)
+        print('Assword database error: %s' % e.msg, file=sys.stderr)
+        print("No changes written.", file=sys.stderr)
+        sys.exit(10)
+    warn_sigvalid(db)
+    warn_hook_errors(db)
+    print("%d changes written." % count, file=sys.stderr)
+
+IMPORT_FORMATS = ['csv', 'jsonl']
+
+def import_file(args):
+    try:
+        opts, args = getopt.gnu_getopt(args, '', ['format=', 'replace', 'dry-run'])
+    except getopt.GetoptError as e:
+        print(e, file=sys.stderr)
         sys.exit(1)
+    fmt = None
+    replace = False
+    dry_run = False
+    for opt, val in opts:
+        if opt == '--format':
+            if val not in IMPORT_FORMATS:
+                print("Unknown import format: %s" % val, file=sys.stderr)
+                sys.exit(1)
+            fmt = val
+        elif opt == '--replace':
+            replace = True
+        elif opt == '--dry-run':
+            dry_run = True
+    if len(args) > 1:
+        print("Only one file may be imported at a time.", file=sys.stderr)
+        sys.exit(1)
+    path = args[0] if args else '-'
+    if fmt is None:
+        ext = os.path.splitext(path)[1].lstrip('.')
+        fmt = ext if ext in IMPORT_FORMATS else 'csv'
+    if path == '-':
+        f = sys.stdin
+    else:
+        try:
+            f = open(path, newline='')
+        except OSError as e:
+            print("Could not open import file: %s" % e, file=sys.stderr)
+            sys.exit(1)
+    keyid = get_keyid()
+    db = open_db(keyid)
+    def conflict(context):
+        print("Conflict: '%s'" % context, file=sys.stderr)
+    # the importer is only loaded for imports
+    import assword.importer
+    pairs = assword.importer.READERS[fmt](f)
+    try:
+        if dry_run:
+            counts = assword.importer.import_entries(db, pairs, replace, conflict)
+        else:
+            with db.transaction():
+                counts = assword.importer.import_entries(db, pairs, replace, conflict)
+    except assword.DatabaseError as e:
+        print('Assword database error: %s' % e.msg, file=sys.stderr)
+        print("No changes written.", file=sys.stderr)
+        sys.exit(10)
+    except UnicodeDecodeError as e:
+        print('Assword database error: import file is not UTF-8: %s' % e, file=sys.stderr)
+        print("No changes written.", file=sys.stderr)
+        sys.exit(10)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+        warn_sigvalid(db)
+    warn_hook_errors(db)
+    print("%d added, %d replaced, %d unchanged, %d conflicts." % (
+        counts['added'], counts['replaced'], counts['unchanged'], counts['conflict']),
+          file=sys.stderr)
+    if dry_run:
+        print("No changes written.", file=sys.stderr)
 
-    cmd = sys.argv[1]
+############################################################
+# main
 
+def run(cmd, args):
     if cmd == 'add':
-        add(sys.argv[2:])
+        add(args)
     elif cmd == 'replace':
-        replace(sys.argv[2:])
+        replace(args)
     elif cmd == 'dump':
-        dump(sys.argv[2:])
+        dump(args)
     elif cmd == 'gui':
         method = os.getenv('ASSWORD_XPASTE', 'xdo')
-        gui(sys.argv[2:], method=method)
+        gui(args, method=method)
     elif cmd == 'remove':
-        remove(sys.argv[2:])
+        remove(args)
+    elif cmd == 'batch':
+        batch(args)
+    elif cmd == 'import':
+        import_file(args)
+    elif cmd == 'compact':
+        compact(args)
+    elif cmd == 'agent':
+        agent(args)
     elif cmd == 'version' or cmd == '--version':
         version()
     elif cmd == 'help' or cmd == '--help':
@@ -339,5 +1139,44 @@ def main():
         usage()
         sys.exit(1)
 
+def main():
+    argv = sys.argv[1:]
+
+    profile = None
+    if argv and (argv[0] == '--profile' or argv[0].startswith('--profile=')):
+        opt = argv.pop(0)
+        if '=' in opt:
+            profile = opt.split('=', 1)[1]
+        elif argv:
+            profile = argv.pop(0)
+        if not profile:
+            print("--profile requires a file name.", file=sys.stderr)
+            sys.exit(1)
+
+    if len(argv) < 1:
+        print("Command not specified.", file=sys.stderr)
+        print(file=sys.stderr)
+        usage()
+        sys.exit(1)
+
+    cmd = argv[0]
+
+    tracefile = os.getenv('ASSWORD_TRACE')
+    if tracefile:
+        assword.trace.enable()
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with assword.trace.span('command', command=cmd):
+            run(cmd, argv[1:])
+    finally:
+        if profile:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        if tracefile:
+            assword.trace.tracer().write(tracefile)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,506 @@
+import os
+import json
+import stat
+import contextlib
+import socket
+import struct
+import socketserver
+
+from . import Database, DatabaseError, pwgen, check_meta, DEFAULT_NEW_PASSWORD_OCTETS
+from . import usage
+from .entry import Entry, entry_default, META_FIELDS
+from .policy import Policy
+from .index import ContextIndex
+
+############################################################
+
+DEFAULT_IDLE_TIMEOUT = 900
+
+def default_socket_path():
+    """Return the default per-user agent socket path."""
+    rundir = os.getenv('XDG_RUNTIME_DIR')
+    if rundir:
+        return os.path.join(rundir, 'assword', 'agent')
+    return os.path.join('/tmp', 'assword-%d' % os.getuid(), 'agent')
+
+def _peer_uid(sock):
+    """uid of the process on the other end of a unix socket.
+
+    Returns None on platforms without SO_PEERCRED, where the mode of
+    the socket directory is the only access control.
+
+    """
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                struct.calcsize('3i'))
+    except (AttributeError, OSError):
+        return None
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid
+
+def _read_message(f):
+    line = f.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+def _write_message(f, msg):
+    f.write(json.dumps(msg, default=entry_default).encode('utf-8') + b'\n')
+    f.flush()
+
+class AgentError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+def _check_socket_dir(path):
+    # the socket directory must be private to this user, so that no
+    # one else can have put a socket there
+    sockdir = os.path.dirname(path)
+    st = os.stat(sockdir)
+    if st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) & 0o077:
+        raise AgentError("Insecure agent socket directory: %s" % sockdir)
+
+def _claim_socket(path):
+    # make sure the socket directory is private, and remove a stale
+    # socket left by a server that is no longer running
+    sockdir = os.path.dirname(path)
+    if not os.path.isdir(sockdir):
+        os.makedirs(sockdir, mode=0o700)
+    _check_socket_dir(path)
+    if os.path.exists(path):
+        if AgentClient(path).ping():
+            raise AgentError("Agent already running at %s" % path)
+        os.unlink(path)
+
+############################################################
+# server
+
+class _Handler(socketserver.StreamRequestHandler):
+    timeout = 10
+
+    def handle(self):
+        try:
+            request = _read_message(self.rfile)
+        except ValueError:
+            return
+        if request is None:
+            return
+        try:
+            result = self.server.agent.dispatch(request)
+            response = {'ok': True, 'result': result}
+        except (AgentError, DatabaseError) as e:
+            response = {'ok': False, 'error': e.msg}
+        except Exception as e:
+            response = {'ok': False, 'error': str(e)}
+        _write_message(self.wfile, response)
+
+class _Server(socketserver.UnixStreamServer):
+    def verify_request(self, request, client_address):
+        uid = _peer_uid(request)
+        return uid is None or uid == os.getuid()
+
+    def handle_timeout(self):
+        self.agent.running = False
+
+class Agent():
+    """Resident assword database agent.
+
+    The database at dbpath is decrypted once and kept in memory.
+    Requests from clients on the same host, as the same user, are
+    served over a unix socket until no request has been received for
+    timeout seconds, at which point the agent exits.
+
+    """
+
+    def __init__(self, dbpath, keyid=None, path=None, timeout=DEFAULT_IDLE_TIMEOUT,
+                 compress=None, shards=None, journal=None, storage=None, hooks=None):
+        self._dbpath = dbpath
+        self._keyid = keyid
+        self._compress = compress
+        self._shards = shards
+        self._journal = journal
+        self._storage = storage
+        self._hooks = hooks
+        self.path = path or default_socket_path()
+        self.timeout = timeout
+        self.running = False
+        self._db = None
+        self._stat = None
+        self._load()
+
+    def _stat_db(self):
+        # saves may only append to the journal
+        stats = []
+        for path in (self._dbpath, self._dbpath + '.journal'):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                stats.append(None)
+                continue
+            stats.append((st.st_ino, st.st_size, st.st_mtime_ns))
+        return tuple(stats)
+
+    def _load(self):
+        self._stat = self._stat_db()
+        self._db = Database(self._dbpath, self._keyid, compress=self._compress,
+                            shards=self._shards, journal=self._journal,
+                            storage=self._storage, hooks=self._hooks)
+        # the agent is long-lived, so index up front for its searches
+        self._db.index
+
+    def _reload_if_changed(self):
+        # pick up writes made by anything that bypassed the agent
+        if self._stat_db() != self._stat:
+            # the uses counted so far would be lost with the old database
+            self._db.save_usage()
+            self._load()
+
+    def _apply(self, ops, keyid=None):
+        with self._db.transaction(keyid or self._keyid):
+            for op in ops:
+                meta = {f: op[f] for f in META_FIELDS if f in op}
+                if op['op'] == 'add':
+                    self._db.add(op['context'], op['password'], **meta)
+                elif op['op'] == 'replace':
+                    self._db.replace(op['context'], op['password'], **meta)
+                elif op['op'] == 'remove':
+                    if op['context'] not in self._db:
+                        raise DatabaseError("Context not found: '%s'" % op['context'])
+                    self._db.remove(op['context'])
+                else:
+                    raise AgentError("Unknown operation: %s" % op['op'])
+        self._stat = self._stat_db()
+
+    def dispatch(self, request):
+        cmd = request.get('cmd')
+        if request.get('dbpath') not in (None, self._dbpath):
+            raise AgentError("Agent is serving a different database: %s" % self._dbpath)
+        if cmd == 'stop':
+            self.running = False
+            return None
+        self._reload_if_changed()
+        if cmd == 'open':
+            return {'sigvalid': self._db.sigvalid,
+                    'journal_truncated': self._db.journal_truncated,
+                    'version': self._db.version,
+                    'contexts': list(self._db)}
+        elif cmd == 'lookup':
+            context = request['context']
+            if context not in self._db:
+                return None
+            return self._db[context]
+        elif cmd == 'search':
+            return self._db.search(request.get('query'),
+                                   ignorecase=request.get('ignorecase', False),
+                                   fuzzy=request.get('fuzzy', False),
+                                   limit=request.get('limit'))
+        elif cmd == 'by_host':
+            return self._db.by_host(request['host'])
+        elif cmd == 'by_tag':
+            return self._db.by_tag(request['tag'])
+        elif cmd == 'tags':
+            return self._db.tags()
+        elif cmd == 'use':
+            # saved with the next change, or when the agent exits
+            self._db.record_use(request['context'])
+            return None
+        elif cmd == 'usage':
+            return self._db.usage
+        elif cmd == 'apply':
+            self._apply(request['ops'], request.get('keyid'))
+            return self._db.hook_errors
+        elif cmd == 'status':
+            return {'dbpath': self._dbpath,
+                    'entries': len(self._db._entries),
+                    'pid': os.getpid()}
+        raise AgentError("Unknown command: %s" % cmd)
+
+    def _bind(self):
+        _claim_socket(self.path)
+        umask = os.umask(0o177)
+        try:
+            server = _Server(self.path, _Handler)
+        finally:
+            os.umask(umask)
+        server.agent = self
+        server.timeout = self.timeout
+        return server
+
+    def serve(self):
+        """Serve requests until stopped or idle for timeout seconds."""
+        server = self._bind()
+        self.running = True
+        try:
+            while self.running:
+                server.handle_request()
+        finally:
+            server.server_close()
+            os.unlink(self.path)
+            try:
+                self._db.save_usage()
+            except DatabaseError:
+                # usage only ranks entries, and is not worth failing for
+                pass
+            self._db = None
+
+############################################################
+# client
+
+class AgentClient():
+    """Client for a running assword agent."""
+
+    def __init__(self, path=None, timeout=10):
+        self.path = path or default_socket_path()
+        self.timeout = timeout
+
+    def request(self, cmd, **kwargs):
+        """Send a request to the agent and return the result.
+
+        Raises OSError if the agent can not be reached, and AgentError
+        if the agent reports a failure.  Nothing is sent, and
+        AgentError is raised, unless the socket is in a directory
+        private to this user and the agent runs as this user.
+
+        """
+        kwargs['cmd'] = cmd
+        _check_socket_dir(self.path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(self.timeout)
+            s.connect(self.path)
+            uid = _peer_uid(s)
+            if uid is not None and uid != os.getuid():
+                raise AgentError("Agent socket is served by another user: %s" % self.path)
+            with s.makefile('rwb') as f:
+                _write_message(f, kwargs)
+                response = _read_message(f)
+        if response is None:
+            raise AgentError("Agent closed connection without response.")
+        if not response['ok']:
+            raise AgentError(response['error'])
+        return response['result']
+
+    def ping(self):
+        """True if an agent is listening on the socket."""
+        try:
+            self.request('status')
+        except (OSError, AgentError):
+            return False
+        return True
+
+class AgentDatabase():
+    """Database proxy backed by a running agent.
+
+    Provides the same interface as Database.  Changes are collected
+    locally and sent to the agent, which applies and saves them in one
+    step, when save() is called.
+
+    """
+
+    def __init__(self, dbpath, keyid=None, path=None):
+        self._dbpath = dbpath
+        self._keyid = keyid
+        self._client = AgentClient(path)
+        info = self._client.request('open', dbpath=dbpath)
+        self._version = info['version']
+        self._sigvalid = info['sigvalid']
+        self._journal_truncated = info.get('journal_truncated', False)
+        self._contexts = set(info['contexts'])
+        self._changed = {}
+        self._ops = []
+        self._hook_errors = []
+        self._index = None
+        self._executor = None
+
+    @property
+    def version(self):
+        """Database version."""
+        return self._version
+
+    @property
+    def path(self):
+        """Path of the database."""
+        return self._dbpath
+
+    @property
+    def sigvalid(self):
+        """Validity of OpenPGP signature on db file."""
+        return self._sigvalid
+
+    @property
+    def journal_truncated(self):
+        """True if the agent ignored a partly written journal record."""
+        return self._journal_truncated
+
+    @property
+    def hook_errors(self):
+        """Errors of the post-save hooks the agent ran on the last save."""
+        return list(self._hook_errors)
+
+    def __str__(self):
+        return '<assword.AgentDatabase "%s">' % (self._dbpath)
+
+    def __repr__(self):
+        return 'assword.AgentDatabase("%s")' % (self._dbpath)
+
+    @property
+    def index(self):
+        """ContextIndex of database contexts (see Database.index)."""
+        if self._index is None:
+            self._index = ContextIndex(self._contexts)
+        return self._index
+
+    def __getitem__(self, context):
+        """Return database entry for exact context."""
+        if context in self._changed:
+            entry = self._changed[context]
+        elif context in self._contexts:
+            entry = self._client.request('lookup', dbpath=self._dbpath, context=context)
+            if entry is not None:
+                entry = Entry.fromdict(entry)
+        else:
+            entry = None
+        if entry is None:
+            raise KeyError(context)
+        return entry
+
+    def __contains__(self, context):
+        """True if context string in database."""
+        return context in self._contexts
+
+    def __iter__(self):
+        """Iterator of all database contexts."""
+        return iter(list(self._contexts))
+
+    def _set_entry(self, op, context, password=None, meta=None):
+        if isinstance(password, Policy):
+            password = password.generate()
+        elif not isinstance(password, str):
+            if password is None:
+                password = DEFAULT_NEW_PASSWORD_OCTETS
+            password = pwgen(password)
+        self._ops.append(dict(meta or {}, op=op, context=context, password=password))
+        e = Entry(password, **(meta or {}))
+        self._contexts.add(context)
+        self._changed[context] = e
+        if self._index is not None:
+            self._index.add(context)
+        return e
+
+    def add(self, context, password=None, username=None, url=None, tags=None):
+        """Add a new entry to the database (see Database.add())."""
+        if context == '':
+            raise DatabaseError("Can not add empty string context")
+        if context in self:
+            raise DatabaseError("Context already exists (see replace())")
+        return self._set_entry('add', context, password, check_meta(username, url, tags))
+
+    def replace(self, context, password=None, username=None, url=None, tags=None):
+        """Replace entry in database (see Database.replace())."""
+        if context not in self:
+            raise DatabaseError("Context not found (see add())")
+        meta = self[context].fields()
+        meta.update(check_meta(username, url, tags))
+        return self._set_entry('replace', context, password, meta)
+
+    def remove(self, context):
+        """Remove an entry from the database (see Database.remove())."""
+        if context not in self:
+            raise KeyError(context)
+        self._ops.append({'op': 'remove', 'context': context})
+        self._contexts.discard(context)
+        self._changed[context] = None
+        if self._index is not None:
+            self._index.remove(context)
+
+    def _request(self, cmd, **kwargs):
+        try:
+            return self._client.request(cmd, dbpath=self._dbpath, **kwargs)
+        except (OSError, AgentError) as e:
+            raise DatabaseError('Agent request failed: %s' % getattr(e, 'msg', e))
+
+    def by_host(self, host):
+        """Contexts whose URLs are for host (see Database.by_host()).
+
+        As with search(), changes that have not been saved yet are not
+        reflected.
+
+        """
+        return self._request('by_host', host=host)
+
+    def by_tag(self, tag):
+        """Contexts with tag (see Database.by_tag())."""
+        return self._request('by_tag', tag=tag)
+
+    def tags(self):
+        """Tags and the number of their contexts (see Database.tags())."""
+        return self._request('tags')
+
+    def record_use(self, context):
+        """Have the agent count a retrieval (see Database.record_use())."""
+        self._request('use', context=context)
+
+    @property
+    def usage(self):
+        """Usage of the agent's database (see Database.usage)."""
+        return self._request('usage')
+
+    def usage_scores(self, now=None):
+        """Dict of context to ranking score (see assword.usage.scores())."""
+        return usage.scores(self.usage, now)
+
+    def save_usage(self, keyid=None):
+        """Does nothing: the agent saves the uses it counts itself."""
+        pass
+
+    def save(self, keyid=None, path=None):
+        """Have the agent apply and save all pending changes."""
+        if path not in (None, self._dbpath):
+            raise DatabaseError('Agent can only save to %s.' % self._dbpath)
+        try:
+            hook_errors = self._client.request('apply', dbpath=self._dbpath,
+                                               keyid=keyid or self._keyid, ops=self._ops)
+        except (OSError, AgentError) as e:
+            raise DatabaseError('Agent save failed: %s' % getattr(e, 'msg', e))
+        self._hook_errors = hook_errors or []
+        self._ops = []
+        self._changed = {}
+
+    def save_async(self, keyid=None, path=None):
+        """Save in a background thread (see Database.save_async())."""
+        if self._executor is None:
+            import concurrent.futures
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self._executor.submit(self.save, keyid, path)
+
+    @contextlib.contextmanager
+    def transaction(self, keyid=None, path=None):
+        """Context manager grouping changes into a single save.
+
+        See Database.transaction().
+
+        """
+        state = (set(self._contexts), dict(self._changed), list(self._ops))
+        try:
+            yield self
+            self.save(keyid, path)
+        except:
+            self._contexts, self._changed, self._ops = state
+            self._index = None
+            raise
+
+    def itersearch(self, query=None, ignorecase=False, fuzzy=False, limit=None):
+        """Iterator of (context, entry) pairs matching query (see search())."""
+        return iter(self.search(query, ignorecase, fuzzy, limit).items())
+
+    def search(self, query=None, ignorecase=False, fuzzy=False, limit=None):
+        """Search for query in contexts (see Database.search()).
+
+        Changes that have not been saved yet are not reflected in the
+        results.
+
+        """
+        results = self._client.request('search', dbpath=self._dbpath, query=query,
+                                       ignorecase=ignorecase, fuzzy=fuzzy, limit=limit)
+        return {context: Entry.fromdict(entry) for context, entry in results.items()}
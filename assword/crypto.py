@@ -0,0 +1,92 @@
+import io
+import gpgme
+import threading
+
+############################################################
+
+class Crypto():
+    """OpenPGP encryption and signing for assword databases.
+
+    Wraps a gpgme context (a new one if context is not given) and
+    caches the keys looked up through it, so that each key is only
+    read from the keyring once.  Operations are serialized, so a
+    Crypto may be shared between threads.
+
+    """
+
+    def __init__(self, context=None):
+        if context is None:
+            context = gpgme.Context()
+        context.armor = True
+        self.context = context
+        self._keys = {}
+        self._signer = None
+        self._lock = threading.Lock()
+
+    def get_key(self, keyid):
+        """Key for keyid (a key ID or fingerprint).
+
+        Raises gpgme.GpgmeError if the key is not found.
+
+        """
+        with self._lock:
+            return self._get_key(keyid)
+
+    def _get_key(self, keyid):
+        key = self._keys.get(keyid)
+        if key is None:
+            key = self.context.get_key(keyid)
+            self._keys[keyid] = key
+            # the same key may later be asked for by another of its
+            # IDs or fingerprints
+            for subkey in getattr(key, 'subkeys', []):
+                self._keys.setdefault(subkey.fpr, key)
+                self._keys.setdefault(subkey.keyid, key)
+        return key
+
+    def decrypt_verify(self, encdata):
+        """Decrypt file object encdata.
+
+        Returns a BytesIO of the cleartext, and True if the signature
+        is fully valid.
+
+        """
+        data = io.BytesIO()
+        with self._lock:
+            sigs = self.context.decrypt_verify(encdata, data)
+        data.seek(0)
+        # an unsigned file has no signatures at all
+        return data, bool(sigs) and sigs[0].validity >= gpgme.VALIDITY_FULL
+
+    def encrypt_sign(self, data, keyid, encdata=None):
+        """Encrypt file object data to keyid, signed by the same key.
+
+        The encrypted data is written to file object encdata, or if
+        encdata is not given to a new BytesIO, which is returned.
+
+        """
+        flags = gpgme.ENCRYPT_ALWAYS_TRUST
+        # callers do their own compression
+        try:
+            flags |= gpgme.ENCRYPT_NO_COMPRESS
+        except AttributeError:
+            pass
+        if encdata is None:
+            encdata = io.BytesIO()
+        with self._lock:
+            key = self._get_key(keyid)
+            if self._signer is not key:
+                self.context.signers = [key]
+                self._signer = key
+            data.seek(0)
+            self.context.encrypt_sign([key], flags, data, encdata)
+        return encdata
+
+_default = None
+
+def default_crypto():
+    """Crypto shared by everything in this process, created on first use."""
+    global _default
+    if _default is None:
+        _default = Crypto()
+    return _default
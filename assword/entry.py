@@ -0,0 +1,186 @@
+import datetime
+import collections.abc
+
+############################################################
+
+# optional entry fields, in the order they are stored
+META_FIELDS = ('username', 'url', 'tags')
+
+def url_host(url):
+    """Lower-cased host name of url, or None.
+
+    A url without a scheme, such as 'example.com/login', is taken to
+    start with the host.
+
+    """
+    if not url:
+        return None
+    # only loaded once there is a url to parse
+    import urllib.parse
+    if '//' not in url:
+        url = '//' + url
+    try:
+        return urllib.parse.urlsplit(url).hostname
+    except ValueError:
+        return None
+
+class Entry(collections.abc.Mapping):
+    """A database entry: a password and the time it was set.
+
+    An Entry is a read-only mapping with the same keys as the entries
+    in the database file, 'password' and 'date', where 'date' is an
+    ISO 8601 string in local time.  Internally the date is kept as a
+    numeric timestamp (the timestamp attribute, in seconds since the
+    epoch), and only rendered as a string when it is asked for, which
+    keeps large databases small in memory.
+
+    Entries may also have any of the optional fields 'username',
+    'url' and 'tags' (a list of strings), which are only keys of the
+    mapping if they are set.  They are kept in one dict, or None for
+    entries with none of them.  Any other fields, such as those
+    written by a newer version, are kept in the same dict (see the
+    extra attribute), so that they are saved with the entry.
+
+    """
+
+    __slots__ = ('password', 'timestamp', 'meta')
+
+    KEYS = ('password', 'date')
+
+    def __init__(self, password, timestamp=None, username=None, url=None, tags=None,
+                 extra=None):
+        self.password = password
+        if timestamp is None:
+            # to the microsecond, as the date is stored, so that the
+            # timestamp is the same once the entry is saved and read
+            timestamp = datetime.datetime.now().timestamp()
+        self.timestamp = timestamp
+        meta = {}
+        if username:
+            meta['username'] = username
+        if url:
+            meta['url'] = url
+        if tags:
+            meta['tags'] = list(tags)
+        if extra:
+            meta.update(extra)
+        self.meta = meta or None
+
+    @classmethod
+    def fromdict(cls, d):
+        """Entry from a dict as stored in the database file.
+
+        Raises ValueError if the date is missing or is not an ISO 8601
+        string.
+
+        """
+        if 'date' not in d:
+            raise ValueError('missing date')
+        try:
+            timestamp = datetime.datetime.fromisoformat(d['date']).timestamp()
+        except (ValueError, TypeError):
+            raise ValueError('invalid date: %r' % (d['date'],))
+        extra = {k: v for k, v in d.items() if k not in _ENTRY_KEYS}
+        return cls(d['password'], timestamp,
+                   d.get('username'), d.get('url'), d.get('tags'), extra)
+
+    @property
+    def date(self):
+        """ISO 8601 string of the local time the entry was set."""
+        return datetime.datetime.fromtimestamp(self.timestamp).isoformat()
+
+    @property
+    def username(self):
+        """User name, or None."""
+        return self.meta and self.meta.get('username')
+
+    @property
+    def url(self):
+        """URL, or None."""
+        return self.meta and self.meta.get('url')
+
+    @property
+    def host(self):
+        """Lower-cased host name of the URL, or None."""
+        return url_host(self.url)
+
+    @property
+    def tags(self):
+        """Tuple of tags."""
+        if self.meta is None:
+            return ()
+        return tuple(self.meta.get('tags', ()))
+
+    @property
+    def extra(self):
+        """Dict of the fields other than the known ones, or None."""
+        if self.meta is None:
+            return None
+        return {k: v for k, v in self.meta.items() if k not in META_FIELDS} or None
+
+    def fields(self):
+        """Dict of the optional fields, as keyword arguments of Entry()."""
+        fields = {f: self.meta[f] for f in META_FIELDS if f in (self.meta or ())}
+        extra = self.extra
+        if extra:
+            fields['extra'] = extra
+        return fields
+
+    def asdict(self):
+        """New dict of the entry, as stored in the database file."""
+        d = {'password': self.password, 'date': self.date}
+        if self.meta:
+            d.update(self.meta)
+        return d
+
+    def __getitem__(self, key):
+        if key == 'password':
+            return self.password
+        if key == 'date':
+            return self.date
+        if self.meta and key in self.meta:
+            return self.meta[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        if self.meta is None:
+            return iter(self.KEYS)
+        return iter(self.KEYS + tuple(self.meta))
+
+    def __len__(self):
+        return len(self.KEYS) + len(self.meta or ())
+
+    def __repr__(self):
+        return 'Entry(%r)' % self.asdict()
+
+_ENTRY_KEYS = frozenset(Entry.KEYS + META_FIELDS)
+
+def entry_hook(obj, invalid=None):
+    """json object_hook turning stored entries into Entry objects.
+
+    Entries are built as the json is parsed, so the dict and date
+    string of each are freed straight away.  Any object with a string
+    password is taken to be an entry; no other object in the database
+    files has one.
+
+    An entry that can not be built raises ValueError, unless invalid
+    is given (e.g. with functools.partial()), in which case the entry
+    and the error are appended to it and the entry is left as a dict,
+    so that parsing completes and the entry can be reported with its
+    context.
+
+    """
+    if isinstance(obj.get('password'), str):
+        try:
+            return Entry.fromdict(obj)
+        except ValueError as e:
+            if invalid is None:
+                raise
+            invalid.append((obj, e))
+    return obj
+
+def entry_default(obj):
+    """json default function serializing Entry objects."""
+    if isinstance(obj, Entry):
+        return obj.asdict()
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
@@ -0,0 +1,222 @@
+from . import trace
+from .index import ContextIndex
+
+############################################################
+
+def open_all(openers, max_workers=None):
+    """Open several databases concurrently.
+
+    openers is a list of callables each returning an open database.
+    They are called in a thread pool, so that the databases are
+    decrypted in parallel and opening them all takes about as long as
+    opening the slowest.  Databases that are to be decrypted at the
+    same time should each have their own assword.crypto.Crypto, as
+    operations through one Crypto are done one at a time.
+
+    Returns the list of databases, in the order of openers.  If any
+    opener raises, the exception is raised here.
+
+    """
+    # only loaded when there are several databases
+    import concurrent.futures
+    with trace.span('open-all', databases=len(openers)):
+        with concurrent.futures.ThreadPoolExecutor(max_workers or len(openers)) as executor:
+            futures = [executor.submit(opener) for opener in openers]
+            return [f.result() for f in futures]
+
+class Federation():
+    """Merged view of several databases.
+
+    Searches and lookups see the entries of all of databases, a list
+    of Database (or AgentDatabase) objects.  Where more than one
+    database has the same context, the entry of the first one in the
+    list is seen.  The source() of each context is the database it is
+    seen in.
+
+    The first database is the primary: all changes (add(), replace(),
+    remove(), record_use()) are made to it, and save() and
+    transaction() save it.
+    The other databases are only read.
+
+    """
+
+    def __init__(self, databases):
+        self.databases = list(databases)
+        self.primary = self.databases[0]
+        self._index = None
+
+    def __str__(self):
+        return '<assword.Federation %s>' % ', '.join(str(db) for db in self.databases)
+
+    def __repr__(self):
+        return 'assword.Federation(%r)' % self.databases
+
+    @property
+    def version(self):
+        """Database version of the primary database."""
+        return self.primary.version
+
+    @property
+    def sigvalid(self):
+        """Validity of OpenPGP signatures on all of the databases.
+
+        False if any signature is invalid, None if all of the
+        databases are new, and True otherwise.
+
+        """
+        valid = [db.sigvalid for db in self.databases]
+        if False in valid:
+            return False
+        if True in valid:
+            return True
+        return None
+
+    def _find(self, context):
+        for db in self.databases:
+            if context in db:
+                return db
+        return None
+
+    def source(self, context):
+        """The database whose entry for context is seen, or None."""
+        return self._find(context)
+
+    def __getitem__(self, context):
+        """Return database entry for exact context."""
+        db = self._find(context)
+        if db is None:
+            raise KeyError(context)
+        return db[context]
+
+    def __contains__(self, context):
+        """True if context string in any of the databases."""
+        return self._find(context) is not None
+
+    def __iter__(self):
+        """Iterator of all contexts, each once."""
+        seen = set()
+        for db in self.databases:
+            for context in db:
+                if context not in seen:
+                    seen.add(context)
+                    yield context
+
+    @property
+    def index(self):
+        """ContextIndex of the contexts of all of the databases."""
+        if self._index is None:
+            self._index = ContextIndex(list(self))
+        return self._index
+
+    def add(self, context, password=None, username=None, url=None, tags=None):
+        """Add a new entry to the primary database (see Database.add())."""
+        entry = self.primary.add(context, password, username, url, tags)
+        if self._index is not None and context not in self._index:
+            self._index.add(context)
+        return entry
+
+    def replace(self, context, password=None, username=None, url=None, tags=None):
+        """Replace entry in the primary database (see Database.replace())."""
+        return self.primary.replace(context, password, username, url, tags)
+
+    def remove(self, context):
+        """Remove an entry from the primary database (see Database.remove()).
+
+        An entry for the context in another database is seen again.
+
+        """
+        self.primary.remove(context)
+        if self._index is not None and context not in self:
+            self._index.remove(context)
+
+    def record_use(self, context):
+        """Count a retrieval in the usage of the primary database.
+
+        The usage of all of the databases is kept with the primary,
+        as the others are only read.
+
+        """
+        self.primary.record_use(context)
+
+    @property
+    def usage(self):
+        """Usage of the primary database (see Database.usage)."""
+        return self.primary.usage
+
+    def usage_scores(self, now=None):
+        """Ranking scores from the usage of the primary database."""
+        return self.primary.usage_scores(now)
+
+    def save_usage(self, keyid=None):
+        """Save the usage of the primary database (see Database.save_usage())."""
+        self.primary.save_usage(keyid)
+
+    @property
+    def hook_errors(self):
+        """Errors of the post-save hooks of the primary database."""
+        return self.primary.hook_errors
+
+    def save(self, keyid=None, path=None):
+        """Save the primary database (see Database.save())."""
+        self.primary.save(keyid, path)
+
+    def save_async(self, keyid=None, path=None):
+        """Save the primary database in the background (see Database.save_async())."""
+        return self.primary.save_async(keyid, path)
+
+    def transaction(self, keyid=None, path=None):
+        """Transaction on the primary database (see Database.transaction())."""
+        # the index may be left with contexts of discarded changes
+        self._index = None
+        return self.primary.transaction(keyid, path)
+
+    def _seen(self, db, contexts):
+        # the contexts whose entries are seen in db
+        return set(c for c in contexts if self._find(c) is db)
+
+    def by_host(self, host):
+        """Sorted list of the contexts whose URLs are for host (see Database.by_host())."""
+        contexts = set()
+        for db in self.databases:
+            contexts |= self._seen(db, db.by_host(host))
+        return sorted(contexts)
+
+    def by_tag(self, tag):
+        """Sorted list of the contexts with tag."""
+        contexts = set()
+        for db in self.databases:
+            contexts |= self._seen(db, db.by_tag(tag))
+        return sorted(contexts)
+
+    def tags(self):
+        """Dict of each tag in the databases to the number of its contexts."""
+        return {tag: len(self.by_tag(tag))
+                for tag in set().union(*(db.tags() for db in self.databases))}
+
+    def itersearch(self, query=None, ignorecase=False, fuzzy=False, limit=None):
+        """Iterator of (context, entry) pairs matching query.
+
+        See Database.search() for the arguments.  Fuzzy matches are
+        ranked across all of the databases.
+
+        """
+        if fuzzy:
+            for context in self.index.fuzzy(query, limit=limit):
+                yield context, self[context]
+            return
+        seen = set()
+        for db in self.databases:
+            for context, entry in db.itersearch(query, ignorecase=ignorecase):
+                if limit is not None and len(seen) >= limit:
+                    return
+                if context not in seen:
+                    seen.add(context)
+                    yield context, entry
+
+    def search(self, query=None, ignorecase=False, fuzzy=False, limit=None):
+        """Search for query in the contexts of all of the databases.
+
+        See Database.search().
+
+        """
+        return dict(self.itersearch(query, ignorecase, fuzzy, limit))
@@ -0,0 +1,508 @@
+import os
+import signal
+import socket
+import threading
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk
+from gi.repository import GObject
+from gi.repository import Gdk
+from gi.repository import GLib
+
+from . import DatabaseError
+from .index import IncrementalMatcher
+from .agent import AgentError, _claim_socket, _peer_uid, _read_message, _write_message
+
+############################################################
+
+# maximum number of completions offered
+COMPLETION_LIMIT = 50
+
+# seconds a ResidentGui keeps the database after a retrieval
+DEFAULT_LOCK_TIMEOUT = 300
+
+def _usage_scores(db):
+    try:
+        return db.usage_scores()
+    except DatabaseError:
+        # without usage completions are simply not ranked by it
+        return {}
+
+# The completion model only ever holds the current matches (see
+# Gui.update_completion), so every row in it matches.
+def _match_all(completion, key, iter, data=None):
+    return True
+
+class Gui:
+    """Assword X-based query UI.
+
+    Either db, the database to query, or opener, a callable returning
+    it, must be given.  With opener the window is shown straight away
+    and the database is opened by calling opener in a background
+    thread, so that the user can start typing while it is decrypted;
+    what has been typed by then is searched for once it arrives.  If
+    opener raises, the exception is raised by returnValue().
+
+    """
+    def __init__(self, db=None, query=None, opener=None):
+        self._init_state(query)
+
+        if db is not None and query:
+            # If we have an intial query, directly do a search without
+            # initializing any X objects.  This will initialize the
+            # database and potentially return entries.
+            r = db.search(query)
+            # If only a single entry is found, _search() will set the
+            # result and attempt to close any X objects (of which
+            # there are none).  Since we don't need to initialize any
+            # GUI, return the initialization immediately.
+            # See .returnValue().
+            if len(r) == 1:
+                self.db = db
+                self._select(list(r.keys())[0])
+                return
+
+        self._build()
+        if query:
+            self.entry.set_text(query)
+
+        if db is not None:
+            self._loaded(db)
+            self.window.show()
+        else:
+            self.window.show()
+            self._open(opener)
+
+    def _init_state(self, query=None):
+        self.db = None
+        self.query = query
+        self.results = None
+        self.selected = None
+        # future for the save of a created entry, which completes in
+        # the background while the password is delivered
+        self.saving = None
+        self.window = None
+        self.entry = None
+        self.label = None
+        self.matcher = None
+        self.notification = None
+        # exception raised by opener
+        self.error = None
+        # set while opener runs
+        self.opening = False
+        # set if the entry is activated before the database is opened
+        self.pending = False
+
+    def _build(self):
+        self.window = Gtk.Window(Gtk.WindowType.TOPLEVEL)
+        self.window.set_border_width(4)
+        windowicon = self.window.render_icon(Gtk.STOCK_DIALOG_AUTHENTICATION, Gtk.IconSize.DIALOG)
+        self.window.set_icon(windowicon)
+
+        self.entry = Gtk.Entry()
+        # Connected before the completion is attached so that the
+        # model is refilled before the completion refilters it.
+        self.entry.connect("changed", self.update_completion)
+        self.liststore = Gtk.ListStore(GObject.TYPE_STRING)
+        completion = Gtk.EntryCompletion()
+        completion.set_model(self.liststore)
+        completion.set_text_column(0)
+        completion.set_match_func(_match_all, None)
+        # cursor-on-match is only emitted with inline selection, which
+        # more_completions() keeps from changing the entry
+        completion.set_inline_selection(True)
+        completion.connect("cursor-on-match", self.more_completions)
+        self.entry.set_completion(completion)
+        hbox = Gtk.HBox()
+        self.vbox = Gtk.VBox()
+        self.button = Gtk.Button("Create")
+        self.label = Gtk.Label(label="decrypting database...")
+        self.window.add(self.vbox)
+
+        self.vbox.add(self.label)
+        self.vbox.pack_end(hbox, False, False, 0)
+        hbox.add(self.entry)
+        hbox.pack_end(self.button, False, False, 0)
+        self.entry.set_width_chars(50)
+        self.entry.connect("activate", self.retrieve)
+        self.entry.connect("changed", self.update_button)
+        self.button.connect("clicked", self.create)
+        self.window.connect("destroy", self.destroy)
+        self.window.connect("key-press-event", self.keypress)
+
+        self.entry.show()
+        self.label.show()
+        self.vbox.show()
+        hbox.show()
+        self.button.show()
+        self.update_button(self.entry)
+
+    def _open(self, opener):
+        self.opening = True
+        self.label.set_text("decrypting database...")
+        threading.Thread(target=self._run_opener, args=(opener,), daemon=True).start()
+
+    def _run_opener(self, opener):
+        # Runs in the worker thread.  GTK is only used from the main
+        # loop, so the result is handed to it with idle_add().
+        try:
+            db = opener()
+            rank = _usage_scores(db)
+        except BaseException as e:
+            GLib.idle_add(self._failed, e)
+        else:
+            GLib.idle_add(self._loaded, db, True, rank)
+
+    def _failed(self, error):
+        self.opening = False
+        self.error = error
+        Gtk.main_quit()
+        return False
+
+    def _loaded(self, db, background=False, rank=None):
+        self.opening = False
+        self.db = db
+        if rank is None:
+            rank = _usage_scores(db)
+        # completions are ranked by use, most used first
+        self.matcher = IncrementalMatcher(self.db.index, limit=COMPLETION_LIMIT, rank=rank)
+        context_len = max(50, max(map(len, self.db), default=0))
+
+        if self.db.sigvalid is False and self.notification is None:
+            self.notification = Gtk.Label()
+            msg = "WARNING: could not validate signature on db file"
+            self.notification.set_markup('<span foreground="red">%s</span>' % msg)
+            if len(msg) > context_len:
+                context_len = len(msg)
+            hsep = Gtk.HSeparator()
+            self.vbox.add(self.notification)
+            self.vbox.add(hsep)
+            self.vbox.reorder_child(self.notification, 0)
+            self.vbox.reorder_child(hsep, 1)
+            self.notification.show()
+            hsep.show()
+
+        self.entry.set_width_chars(context_len)
+        self.label.set_text("enter context for desired password:")
+
+        text = self.entry.get_text()
+        if background and self.query and text == self.query:
+            # the initial query shortcut, if the query was not edited
+            # while the database was opened
+            r = self.db.search(self.query)
+            if len(r) == 1:
+                self._select(list(r.keys())[0])
+                self.finish()
+                return False
+
+        # apply what was typed while the database was opened
+        self.update_completion(self.entry)
+        self.update_button(self.entry)
+        if self.pending:
+            self.pending = False
+            self.retrieve(self.entry)
+        return False
+
+    def _select(self, context):
+        self.selected = self.db[context]
+        try:
+            self.db.record_use(context)
+        except DatabaseError:
+            # usage only ranks completions, and is not worth failing for
+            pass
+
+    def finish(self):
+        """Called when the user is done: an entry is selected, or not."""
+        Gtk.main_quit()
+
+    def keypress(self, widget, event):
+        if event.keyval == Gdk.KEY_Escape:
+            self.finish()
+
+    def update_completion(self, widget, data=None):
+        if self.matcher is None:
+            return
+        matches = self.matcher.update(self.entry.get_text())
+        self.liststore.clear()
+        for context in matches:
+            self.liststore.insert_with_valuesv(-1, [0], [context])
+
+    def more_completions(self, completion, model, iter):
+        # the cursor is on the last completion: fetch more, if there are
+        if model.iter_next(iter) is None and self.matcher is not None:
+            for context in self.matcher.more():
+                self.liststore.insert_with_valuesv(-1, [0], [context])
+        # handled, so the entry is left as typed
+        return True
+
+    def update_button(self, widget, data=None):
+        e = self.entry.get_text()
+        self.button.set_sensitive(self.db is not None and e != '' and e not in self.db)
+
+    def retrieve(self, widget, data=None):
+        if self.db is None:
+            self.pending = True
+            return
+        e = self.entry.get_text()
+        if e in self.db:
+            self._select(e)
+            if self.selected is None:
+                self.label.set_text("weird -- no context found even though we thought there should be one")
+            else:
+                self.finish()
+        else:
+            self.label.set_text("no match")
+
+    def create(self, widget, data=None):
+        e = self.entry.get_text()
+        self.db.add(e)
+        self._select(e)
+        self.saving = self.db.save_async()
+        self.finish()
+
+    def destroy(self, widget, data=None):
+        Gtk.main_quit()
+
+    def close(self):
+        """Take the window down once the user is done with it.
+
+        The main loop may be run again after returnValue() (e.g. to
+        serve an X selection), and the window must not be left up to
+        be used meanwhile.
+
+        """
+        if self.window is None:
+            return
+        self.window.hide()
+        # let the window go before the password is delivered
+        self.window.get_display().flush()
+
+    def returnValue(self):
+        if self.selected is None:
+            Gtk.main()
+        if self.error is not None:
+            raise self.error
+        return self.selected
+
+class ResidentGui(Gui):
+    """Gui that stays running, hidden between retrievals.
+
+    The window is built once, the database is opened with opener in
+    the background straight away, and the window is shown again for
+    each show() request, so that it pops up without any startup cost.
+    Requests are taken from a unix socket (see listen()), speaking the
+    same protocol as the agent, and SIGUSR1 shows the window with no
+    query.
+
+    target, if given, is called when the window is shown and returns
+    the target of the retrieval (e.g. the window that had focus, for
+    typing the password into).  deliver is called with the selected
+    entry and that target.
+
+    Once lock_timeout seconds have passed since the window was last
+    hidden the database is dropped from memory, and it is opened again
+    the next time the window is shown.
+
+    """
+    def __init__(self, opener, deliver, target=None, lock_timeout=DEFAULT_LOCK_TIMEOUT):
+        self._init_state()
+        self.opener = opener
+        self.deliver = deliver
+        self.target = target
+        self.lock_timeout = lock_timeout
+        # target of the current retrieval
+        self.current = None
+        self._lock_source = None
+        self._sock = None
+        self._sockpath = None
+
+        self._build()
+        # closing the window only hides it
+        self.window.connect("delete-event", self._delete)
+        self._open(opener)
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, self._signal_show)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, sig, self._signal_stop)
+
+    def _signal_show(self):
+        self.show()
+        return True
+
+    def _signal_stop(self):
+        Gtk.main_quit()
+        return False
+
+    def _show_idle(self, query):
+        self.show(query)
+        return False
+
+    def _delete(self, widget, event):
+        self.finish()
+        return True
+
+    def destroy(self, widget, data=None):
+        pass
+
+    def _failed(self, error):
+        # keep running; the database is opened again on the next show()
+        self.opening = False
+        self.label.set_text("could not open database: %s" % getattr(error, 'msg', error))
+        return False
+
+    def show(self, query=None):
+        """Show the window for a retrieval, with query as initial search."""
+        if self._lock_source is not None:
+            GLib.source_remove(self._lock_source)
+            self._lock_source = None
+        if self.window.get_visible():
+            self.window.present()
+            return
+        self.current = self.target() if self.target is not None else None
+        self.query = query
+        self.selected = None
+        self.pending = False
+        if self.db is not None and query:
+            # as in Gui, a single match is delivered without showing
+            # the window
+            r = self.db.search(query)
+            if len(r) == 1:
+                self._select(list(r.keys())[0])
+                self.finish()
+                return
+        if self.matcher is not None:
+            # rank by the uses counted since the database was opened
+            self.matcher.rank = _usage_scores(self.db)
+        self.entry.set_text(query or '')
+        if self.db is None and not self.opening:
+            self._open(self.opener)
+        elif self.db is not None:
+            self.label.set_text("enter context for desired password:")
+        self.window.show()
+        self.window.present()
+
+    def finish(self):
+        self.close()
+        self.entry.set_text('')
+        self.query = None
+        self.pending = False
+        selected, self.selected = self.selected, None
+        if selected is not None:
+            self.deliver(selected, self.current)
+        self.current = None
+        if self.saving is not None:
+            saving, self.saving = self.saving, None
+            try:
+                saving.result()
+            except DatabaseError as e:
+                self.label.set_text("could not save new entry: %s" % e.msg)
+            else:
+                for error in self.db.hook_errors:
+                    self.label.set_text("new entry saved, but %s" % error)
+        self._schedule_lock()
+
+    def _loaded(self, db, background=False, rank=None):
+        result = super()._loaded(db, background, rank)
+        # opened without being shown, e.g. on startup
+        if not self.window.get_visible():
+            self._schedule_lock()
+        return result
+
+    def _schedule_lock(self):
+        if self._lock_source is not None:
+            GLib.source_remove(self._lock_source)
+        self._lock_source = GLib.timeout_add_seconds(self.lock_timeout, self.lock)
+
+    def _save_usage(self):
+        # the uses counted since the database was opened
+        if self.db is None:
+            return
+        try:
+            self.db.save_usage()
+        except DatabaseError as e:
+            self.label.set_text("could not save usage: %s" % e.msg)
+
+    def lock(self):
+        """Drop the database from memory, until the window is next shown."""
+        self._lock_source = None
+        if self.window.get_visible() or self.opening:
+            return False
+        self._save_usage()
+        self.db = None
+        self.matcher = None
+        self.liststore.clear()
+        self.update_button(self.entry)
+        return False
+
+    def dispatch(self, request):
+        cmd = request.get('cmd')
+        if cmd == 'show':
+            # shown once the response is sent
+            GLib.idle_add(self._show_idle, request.get('query'))
+            return None
+        elif cmd == 'lock':
+            self.lock()
+            return None
+        elif cmd == 'stop':
+            Gtk.main_quit()
+            return None
+        elif cmd == 'status':
+            return {'pid': os.getpid(),
+                    'locked': self.db is None,
+                    'visible': self.window.get_visible()}
+        raise AgentError("Unknown command: %s" % cmd)
+
+    def _accept(self, source, condition):
+        try:
+            conn, addr = self._sock.accept()
+        except OSError:
+            return True
+        with conn:
+            uid = _peer_uid(conn)
+            if uid is not None and uid != os.getuid():
+                return True
+            # requests are small and sent at once
+            conn.settimeout(1)
+            try:
+                with conn.makefile('rwb') as f:
+                    request = _read_message(f)
+                    if request is None:
+                        return True
+                    try:
+                        response = {'ok': True, 'result': self.dispatch(request)}
+                    except AgentError as e:
+                        response = {'ok': False, 'error': e.msg}
+                    _write_message(f, response)
+            except (OSError, ValueError):
+                pass
+        return True
+
+    def listen(self, path):
+        """Take requests on the unix socket at path.
+
+        Requests are served from the GTK main loop; use AgentClient to
+        send them.  Commands are 'show' (with optional 'query'),
+        'lock', 'status' and 'stop'.
+
+        """
+        _claim_socket(path)
+        umask = os.umask(0o177)
+        try:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.bind(path)
+            self._sock.listen()
+        finally:
+            os.umask(umask)
+        self._sockpath = path
+        GLib.io_add_watch(self._sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._accept)
+
+    def serve(self):
+        """Run until stopped."""
+        try:
+            Gtk.main()
+        finally:
+            if self._sock is not None:
+                self._sock.close()
+                os.unlink(self._sockpath)
+            self._save_usage()
+            self.db = None
@@ -0,0 +1,112 @@
+import csv
+import json
+import urllib.parse
+
+from . import DatabaseError
+
+############################################################
+
+# Readers take a text file object and yield (context, password) pairs
+# as they read it, so that large exports are never held in memory as a
+# whole.  Bad records raise DatabaseError with their line number.
+
+def read_jsonl(f):
+    """Pairs from JSON lines of objects with 'context' and 'password'."""
+    for lineno, line in enumerate(f, 1):
+        if line.strip() == '':
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise DatabaseError('line %d: invalid JSON: %s' % (lineno, e))
+        if not isinstance(record, dict) \
+           or not isinstance(record.get('context'), str) \
+           or not isinstance(record.get('password'), str):
+            raise DatabaseError("line %d: record must have string 'context' and 'password'" % lineno)
+        yield record['context'], record['password']
+
+def browser_context(url, username):
+    """Context for a login exported by a web browser: username@host."""
+    host = urllib.parse.urlsplit(url).hostname or url
+    if username:
+        return '%s@%s' % (username, host)
+    return host
+
+def read_csv(f):
+    """Pairs from CSV with a header line.
+
+    Either the columns 'context' and 'password', or the login exports
+    of Firefox ('url', 'username', 'password', ...) and Chromium
+    ('name', 'url', 'username', 'password', ...), whose contexts are
+    made with browser_context().
+
+    """
+    reader = csv.DictReader(f)
+    fields = reader.fieldnames or []
+    if 'context' in fields and 'password' in fields:
+        browser = False
+    elif 'url' in fields and 'username' in fields and 'password' in fields:
+        browser = True
+    else:
+        raise DatabaseError("CSV must have 'context' and 'password' columns, "
+                            "or 'url', 'username' and 'password' columns")
+    try:
+        for record in reader:
+            yield _csv_pair(reader, record, browser)
+    except csv.Error as e:
+        raise DatabaseError('line %d: %s' % (reader.line_num, e))
+
+def _csv_pair(reader, record, browser):
+    if browser:
+        context = browser_context(record['url'], record['username'])
+    else:
+        context = record['context']
+    if not context or record['password'] is None:
+        raise DatabaseError('line %d: incomplete record' % reader.line_num)
+    return context, record['password']
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+def import_entries(db, pairs, replace=False, conflict=None):
+    """Add the (context, password) pairs to db as they are read.
+
+    Contexts that are not in the database are added.  Contexts that
+    are already in the database with the same password are left
+    alone.  Contexts in the database with a different password are
+    conflicts: they are replaced if replace is True, and otherwise
+    left alone.  conflict, if given, is called with each conflicting
+    context.  A context given more than once is imported as its last
+    password.
+
+    The changes are not saved; use db.transaction() to save them all
+    at once.  Returns a dict counting the contexts 'added', 'replaced',
+    'unchanged' and in 'conflict'.
+
+    """
+    # what was done with each context
+    done = {}
+    for context, password in pairs:
+        if done.get(context) in ('added', 'replaced'):
+            # repeated in the input; the last password wins
+            if db[context]['password'] != password:
+                db.replace(context, password)
+        elif context not in db:
+            db.add(context, password)
+            done[context] = 'added'
+        elif db[context]['password'] == password:
+            done[context] = 'unchanged'
+        else:
+            if conflict is not None and done.get(context) != 'conflict':
+                conflict(context)
+            if replace:
+                db.replace(context, password)
+                done[context] = 'replaced'
+            else:
+                done[context] = 'conflict'
+    counts = {'added': 0, 'replaced': 0, 'unchanged': 0, 'conflict': 0}
+    for what in done.values():
+        counts[what] += 1
+    return counts
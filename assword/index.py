@@ -0,0 +1,363 @@
+import re
+import heapq
+import itertools
+import bisect
+
+############################################################
+
+def scan(contexts, query=None, ignorecase=False, limit=None):
+    """Iterator of contexts containing query, without an index.
+
+    Takes the same arguments as ContextIndex.itersearch(), and is
+    cheaper than building an index for a single query.
+
+    """
+    if not query:
+        return itertools.islice(contexts, limit)
+    if ignorecase:
+        lquery = query.lower()
+        matches = (c for c in contexts if lquery in c.lower())
+    else:
+        matches = (c for c in contexts if query in c)
+    return itertools.islice(matches, limit)
+
+# str.lower() lower-cases each character on its own, except for the
+# capital sigma, which becomes a final sigma at the end of a word.  A
+# query containing one may thus match a context whose lower-cased form
+# does not contain the lower-cased query.
+_CONTEXTUAL_LOWER = '\u03a3'
+
+def _trigrams(s):
+    return set(s[i:i+3] for i in range(len(s) - 2))
+
+class ContextIndex():
+    """Search index over database contexts.
+
+    Contexts are indexed by the trigrams of their lower-cased form.
+    Substring queries of three or more characters only examine
+    contexts that contain every trigram of the query.  Shorter
+    queries are checked against the pre-lowered contexts, stopping as
+    soon as enough results are found.  Fuzzy (subsequence) queries
+    are matched in a single regular expression pass over one
+    newline-joined string of all lower-cased contexts, which is
+    rebuilt lazily after changes.
+
+    """
+
+    def __init__(self, contexts=()):
+        self._contexts = []
+        self._lower = []
+        self._ids = {}
+        self._free = []
+        self._trigrams = {}
+        self._blob = None
+        self._offsets = None
+        self._blob_ids = None
+        self._bulk_add(contexts)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, context):
+        return context in self._ids
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def add(self, context):
+        """Add context to the index."""
+        if context in self._ids:
+            return
+        lower = context.lower()
+        if self._free:
+            i = self._free.pop()
+            self._contexts[i] = context
+            self._lower[i] = lower
+        else:
+            i = len(self._contexts)
+            self._contexts.append(context)
+            self._lower.append(lower)
+        self._ids[context] = i
+        for t in _trigrams(lower):
+            self._trigrams.setdefault(t, set()).add(i)
+        self._blob = None
+
+    def _bulk_add(self, contexts):
+        # same as add() for each context, for building a fresh index
+        ids = self._ids
+        lowers = self._lower
+        trigrams = self._trigrams
+        for context in contexts:
+            if context in ids:
+                continue
+            lower = context.lower()
+            i = len(lowers)
+            self._contexts.append(context)
+            lowers.append(lower)
+            ids[context] = i
+            for j in range(len(lower) - 2):
+                t = lower[j:j+3]
+                p = trigrams.get(t)
+                if p is None:
+                    trigrams[t] = {i}
+                else:
+                    p.add(i)
+        self._blob = None
+
+    def remove(self, context):
+        """Remove context from the index."""
+        i = self._ids.pop(context, None)
+        if i is None:
+            return
+        for t in _trigrams(self._lower[i]):
+            ids = self._trigrams[t]
+            ids.discard(i)
+            if not ids:
+                del self._trigrams[t]
+        self._contexts[i] = None
+        self._lower[i] = None
+        self._free.append(i)
+        self._blob = None
+
+    def _build_blob(self):
+        # Contexts may themselves contain newlines, which is harmless:
+        # matches are mapped back to contexts by offset, and verified.
+        parts = []
+        offsets = []
+        ids = []
+        pos = 0
+        for i, lower in enumerate(self._lower):
+            if lower is None:
+                continue
+            parts.append(lower)
+            offsets.append(pos)
+            ids.append(i)
+            pos += len(lower) + 1
+        self._blob = '\n'.join(parts)
+        self._offsets = offsets
+        self._blob_ids = ids
+
+    def _locate(self, pos):
+        # position in the blob of the context containing offset pos
+        return bisect.bisect_right(self._offsets, pos) - 1
+
+    def _scan(self, lquery):
+        # all ids whose lower-cased context contains lquery, in index order
+        return (i for i, lower in enumerate(self._lower)
+                if lower is not None and lquery in lower)
+
+    def _candidates(self, lquery):
+        if len(lquery) < 3:
+            return self._scan(lquery)
+        postings = []
+        for t in _trigrams(lquery):
+            ids = self._trigrams.get(t)
+            if not ids:
+                return []
+            postings.append(ids)
+        postings.sort(key=len)
+        ids = set(postings[0])
+        for p in postings[1:]:
+            ids &= p
+            if not ids:
+                return []
+        return sorted(ids)
+
+    def itersearch(self, query=None, ignorecase=False, limit=None):
+        """Iterator of contexts containing query as a substring.
+
+        If query is None or empty all contexts are returned.  Matching
+        is case-sensitive unless ignorecase is True.  At most limit
+        results are returned if limit is not None.
+
+        """
+        if not query:
+            return itertools.islice(self._ids, limit)
+        lquery = query.lower()
+        if ignorecase:
+            matches = (self._contexts[i] for i in self._candidates(lquery)
+                       if lquery in self._lower[i])
+        else:
+            if _CONTEXTUAL_LOWER in query:
+                # the trigrams can not narrow this query down
+                candidates = (i for i, c in enumerate(self._contexts) if c is not None)
+            else:
+                candidates = self._candidates(lquery)
+            matches = (self._contexts[i] for i in candidates
+                       if query in self._contexts[i])
+        return itertools.islice(matches, limit)
+
+    def search(self, query=None, ignorecase=False, limit=None):
+        """List of contexts containing query as a substring (see itersearch())."""
+        return list(self.itersearch(query, ignorecase, limit))
+
+    def fuzzy(self, query, limit=None):
+        """Ranked list of contexts containing the characters of query in order.
+
+        Matching is case-insensitive.  Results are ranked so that
+        tighter matches come first, then matches nearer the start of
+        the context, then shorter contexts.
+
+        """
+        if not query:
+            return self.search(None, limit=limit)
+        if self._blob is None:
+            self._build_blob()
+        lquery = query.lower()
+        pattern = re.compile('[^\n]*?'.join(re.escape(c) for c in lquery))
+        best = {}
+        for m in pattern.finditer(self._blob):
+            k = self._locate(m.start())
+            i = self._blob_ids[k]
+            start = m.start() - self._offsets[k]
+            score = (m.end() - m.start() - len(lquery), start, len(self._lower[i]))
+            if i not in best or score < best[i]:
+                best[i] = score
+        ranked = sorted(best, key=lambda i: (best[i], self._contexts[i]))
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [self._contexts[i] for i in ranked]
+
+    def isearch_lowered(self, lquery):
+        """List of (lower-cased context, context) pairs containing lquery.
+
+        lquery must already be lower-cased.
+
+        """
+        lowers = self._lower
+        contexts = self._contexts
+        if not lquery:
+            return [(lowers[i], contexts[i]) for i in self._ids.values()]
+        return [(lowers[i], contexts[i]) for i in self._candidates(lquery)
+                if lquery in lowers[i]]
+
+############################################################
+
+class IncrementalMatcher():
+    """Case-insensitive completion matcher over a ContextIndex.
+
+    update() is called with the full text of the entry on every
+    change.  If the new text contains the previous text, the new
+    matches are a subset of the previous ones, so only those are
+    re-checked instead of querying the whole index again.  The best
+    limit matches are returned, ranked by their score in rank (a dict
+    of context to score, higher first, see assword.usage.scores()) if
+    given, then position of the match, then context length.  more()
+    returns further matches on demand.
+
+    """
+
+    def __init__(self, index, limit=50, rank=None):
+        self._index = index
+        self.limit = limit
+        self.rank = rank or {}
+        self._key = None
+        self._matches = None
+        self._shown = 0
+
+    def reset(self):
+        """Forget previous matches, e.g. after the index changed."""
+        self._key = None
+        self._matches = None
+        self._shown = 0
+
+    def _top(self, n):
+        key = self._key
+        rank = self.rank
+        top = heapq.nsmallest(n, self._matches,
+                              key=lambda m: (-rank.get(m[1], 0), m[0].find(key),
+                                             len(m[0]), m[1]))
+        return [m[1] for m in top]
+
+    def update(self, text):
+        """Return the best matches for text."""
+        key = text.lower()
+        if self._key is not None and self._key in key:
+            if key != self._key:
+                self._matches = [m for m in self._matches if key in m[0]]
+        else:
+            self._matches = self._index.isearch_lowered(key)
+        self._key = key
+        self._shown = self.limit
+        return self._top(self.limit)
+
+    def more(self, count=None):
+        """Return the next count (default limit) matches for the last text.
+
+        These are the matches ranked after all of those returned by
+        update() and more() since the text last changed.
+
+        """
+        if self._matches is None:
+            return []
+        top = self._top(self._shown + (count or self.limit))
+        more = top[self._shown:]
+        self._shown = len(top)
+        return more
+
+############################################################
+
+class MetaIndex():
+    """Index of contexts by the host and tags of their entries.
+
+    Looking up the contexts for a host or tag takes constant time,
+    rather than a scan of all of the entries.  See
+    assword.entry.Entry for the entry fields.
+
+    """
+
+    def __init__(self, entries=None):
+        self._hosts = {}
+        self._tags = {}
+        for context, entry in (entries or {}).items():
+            self.add(context, entry)
+
+    def add(self, context, entry):
+        """Index context, whose entry is entry."""
+        if entry.meta is None:
+            return
+        host = entry.host
+        if host:
+            self._hosts.setdefault(host, set()).add(context)
+        for tag in entry.tags:
+            self._tags.setdefault(tag, set()).add(context)
+
+    def remove(self, context, entry):
+        """Remove context, indexed with entry, from the index."""
+        if entry.meta is None:
+            return
+        host = entry.host
+        if host:
+            _discard(self._hosts, host, context)
+        for tag in entry.tags:
+            _discard(self._tags, tag, context)
+
+    def host(self, host):
+        """Set of the contexts for host or a domain it is in.
+
+        Contexts whose URLs are for 'example.com' are found for
+        'www.example.com' as well as for 'example.com'.  host is
+        matched case-insensitively.
+
+        """
+        host = host.lower().rstrip('.')
+        contexts = set()
+        while host:
+            contexts |= self._hosts.get(host, set())
+            host = host.partition('.')[2]
+        return contexts
+
+    def tag(self, tag):
+        """Set of the contexts with tag."""
+        return set(self._tags.get(tag, ()))
+
+    def tags(self):
+        """Dict of each tag to the number of contexts with it."""
+        return {tag: len(contexts) for tag, contexts in self._tags.items()}
+
+def _discard(index, key, context):
+    contexts = index.get(key)
+    if contexts is not None:
+        contexts.discard(context)
+        if not contexts:
+            del index[key]
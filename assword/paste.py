@@ -0,0 +1,187 @@
+import fnmatch
+import importlib
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk
+from gi.repository import Gdk
+from gi.repository import GLib
+
+from . import trace
+
+############################################################
+
+# Delivery of retrieved passwords to where they are needed, done in
+# the GUI process itself: no shell or helper process is started, so
+# nothing outside it ever holds the password.  Each stage is recorded
+# as a trace span (see assword.trace).
+
+# seconds a password is held in an X selection before it is cleared
+DEFAULT_CLEAR_TIMEOUT = 45
+
+class PasteError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+class Paste():
+    """Password delivery method.
+
+    target() is called before the GUI is shown, and returns where the
+    password should go (e.g. the window that has focus).
+    deliver(password, target) then sends it there.  Methods that leave
+    the password to be served from the GTK main loop (X selections)
+    keep doing so after deliver() returns; wait() runs the main loop
+    until they are done, for processes that would otherwise exit.
+
+    """
+
+    def target(self):
+        return None
+
+    def deliver(self, password, target):
+        raise NotImplementedError
+
+    def wait(self):
+        pass
+
+class XdoPaste(Paste):
+    """Type the password into the window that had focus.
+
+    By default the window is focused again and the password is typed
+    into the X session as a whole, which works with all applications.
+    Windows whose names match one of the shell patterns in sendevent
+    are instead sent the keystrokes directly with XSendEvent, without
+    focusing them, which can not leak to other windows but is ignored
+    by some applications.
+
+    """
+
+    def __init__(self, sendevent=None):
+        try:
+            import xdo
+        except ImportError:
+            raise PasteError("The xdo module is not found, so the 'xdo' paste method is not available.  "
+                             "Please install python3-xdo.")
+        self._xdo = xdo.xdo()
+        self.sendevent = list(sendevent or [])
+
+    def target(self):
+        # the id of the currently focused window
+        return self._xdo.get_focused_window()
+
+    def _window_name(self, win):
+        try:
+            name = self._xdo.get_window_name(win)
+        except (AttributeError, OSError):
+            return ''
+        if isinstance(name, bytes):
+            name = name.decode('utf-8', 'replace')
+        return name or ''
+
+    def uses_sendevent(self, win):
+        """True if keystrokes for win are sent with XSendEvent."""
+        if not self.sendevent:
+            return False
+        name = self._window_name(win)
+        return any(fnmatch.fnmatchcase(name, p) for p in self.sendevent)
+
+    def deliver(self, password, win):
+        if self.uses_sendevent(win):
+            with trace.span('paste-type', sendevent=True):
+                self._xdo.type(password, window=win)
+            return
+        # type the password in the saved window
+        with trace.span('paste-focus'):
+            self._xdo.focus_window(win)
+            self._xdo.wait_for_window_focus(win)
+        with trace.span('paste-type', sendevent=False):
+            self._xdo.type(password)
+
+class SelectionPaste(Paste):
+    """Put the password in an X selection, and clear it after a while.
+
+    selection is Gdk.SELECTION_CLIPBOARD or Gdk.SELECTION_PRIMARY.
+    The selection is served from the GTK main loop of this process
+    until timeout seconds after deliver(), when it is cleared, unless
+    another application has taken the selection over by then.
+
+    """
+
+    def __init__(self, selection=Gdk.SELECTION_CLIPBOARD, timeout=DEFAULT_CLEAR_TIMEOUT):
+        if timeout <= 0:
+            raise PasteError("Selection clear timeout must be positive.")
+        self.selection = selection
+        self.timeout = timeout
+        self._clipboard = None
+        self._source = None
+        self._waiting = False
+
+    def deliver(self, password, target):
+        with trace.span('paste-set'):
+            self._clipboard = Gtk.Clipboard.get(self.selection)
+            self._clipboard.set_text(password, -1)
+        if self._source is not None:
+            GLib.source_remove(self._source)
+        self._source = GLib.timeout_add_seconds(self.timeout, self.clear)
+
+    def clear(self):
+        """Clear the selection now, if it is still ours."""
+        if self._source is not None:
+            GLib.source_remove(self._source)
+            self._source = None
+        if self._clipboard is not None:
+            with trace.span('paste-clear'):
+                # only gives up the selection if this process owns it
+                self._clipboard.clear()
+            self._clipboard = None
+        if self._waiting:
+            self._waiting = False
+            Gtk.main_quit()
+        return False
+
+    def wait(self):
+        if self._clipboard is None:
+            return
+        self._waiting = True
+        with trace.span('paste-hold', timeout=self.timeout):
+            Gtk.main()
+
+def _clipboard(sendevent=None, timeout=DEFAULT_CLEAR_TIMEOUT):
+    return SelectionPaste(Gdk.SELECTION_CLIPBOARD, timeout)
+
+def _primary(sendevent=None, timeout=DEFAULT_CLEAR_TIMEOUT):
+    return SelectionPaste(Gdk.SELECTION_PRIMARY, timeout)
+
+def _xdo(sendevent=None, timeout=DEFAULT_CLEAR_TIMEOUT):
+    return XdoPaste(sendevent)
+
+# Paste method names and their factories, which are called with the
+# options of get() as keyword arguments.  'xclip' is the selection
+# the xclip tool used to be run to fill.
+METHODS = {
+    'xdo': _xdo,
+    'clipboard': _clipboard,
+    'xclip': _primary,
+}
+
+def get(method, **options):
+    """The Paste for the named method.
+
+    method is one of the METHODS, or 'MODULE:NAME' for a factory (or
+    Paste subclass) NAME importable from MODULE, which is called with
+    the options: sendevent (window name patterns, see XdoPaste) and
+    timeout (see SelectionPaste).
+
+    """
+    if method in METHODS:
+        return METHODS[method](**options)
+    module, sep, name = method.partition(':')
+    if not sep:
+        raise PasteError("Unknown X paste method: %s" % method)
+    try:
+        factory = getattr(importlib.import_module(module), name)
+    except (ImportError, AttributeError) as e:
+        raise PasteError("Could not load X paste method %s: %s" % (method, e))
+    return factory(**options)
@@ -0,0 +1,201 @@
+import os
+import json
+import string
+import fnmatch
+
+############################################################
+
+# character classes that policies can be built from
+CLASSES = {
+    'lower': string.ascii_lowercase,
+    'upper': string.ascii_uppercase,
+    'digits': string.digits,
+    'symbols': string.punctuation,
+}
+
+DEFAULT_LENGTH = 24
+DEFAULT_CLASSES = ['lower', 'upper', 'digits']
+
+# random bytes drawn from the OS at a time; generating a password
+# then mostly just slices the buffer
+POOL_BYTES = 4096
+
+class PolicyError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+class Policy():
+    """Password generation policy.
+
+    Passwords are exactly length characters drawn uniformly from
+    alphabet, or if alphabet is not given from the union of the named
+    character classes (see CLASSES).  Passwords without at least one
+    character from each class named in require are rejected and drawn
+    again; require defaults to all of classes when no alphabet is
+    given, and to none when one is.
+
+    Characters are picked by mapping bytes from a large buffer of
+    os.urandom() output onto the alphabet, dropping the bytes past
+    the largest multiple of the alphabet size so that every character
+    is equally likely.  A Policy is not safe to share between threads.
+
+    """
+
+    def __init__(self, length=DEFAULT_LENGTH, classes=None, require=None, alphabet=None):
+        if alphabet is None:
+            classes = list(classes or DEFAULT_CLASSES)
+            for c in classes:
+                if c not in CLASSES:
+                    raise PolicyError("Unknown character class: %s" % c)
+            alphabet = ''.join(CLASSES[c] for c in classes)
+            if require is None:
+                require = classes
+        else:
+            classes = []
+        require = list(require or [])
+        for c in require:
+            if c not in CLASSES:
+                raise PolicyError("Unknown character class: %s" % c)
+        try:
+            alphabet = alphabet.encode('ascii')
+        except UnicodeEncodeError:
+            raise PolicyError("Password alphabet must be ASCII.")
+        # duplicate characters would be more likely than the others
+        alphabet = bytes(sorted(set(alphabet)))
+        if len(alphabet) < 2:
+            raise PolicyError("Password alphabet must have at least two characters.")
+        if not isinstance(length, int) or length < max(1, len(require)):
+            raise PolicyError("Password length must be at least %d." % max(1, len(require)))
+        for c in require:
+            if not set(CLASSES[c].encode('ascii')) & set(alphabet):
+                raise PolicyError("Required class not in alphabet: %s" % c)
+        self.length = length
+        self.classes = classes
+        self.require = require
+        self.alphabet = alphabet.decode('ascii')
+
+        # bytes.translate() table mapping each random byte onto the
+        # alphabet, and the bytes to drop first to keep that unbiased
+        n = len(alphabet)
+        limit = 256 - 256 % n
+        self._table = bytes(alphabet[b % n] for b in range(256))
+        self._reject = bytes(range(limit, 256))
+        # for each required class, the alphabet characters outside it;
+        # a password has a character of the class if deleting these
+        # leaves anything
+        self._others = [bytes(set(alphabet) - set(CLASSES[c].encode('ascii')))
+                        for c in require]
+        self._pool = b''
+
+    @classmethod
+    def parse(cls, spec):
+        """Policy from a spec string.
+
+        The spec is a comma-separated list of settings: length=N,
+        classes=CLASS+CLASS..., require=CLASS+CLASS... and
+        alphabet=CHARS.  As the alphabet may itself contain commas,
+        alphabet= must come last and takes the rest of the spec.
+
+        """
+        kwargs = {}
+        rest = spec
+        while rest:
+            if rest.startswith('alphabet='):
+                kwargs['alphabet'] = rest[len('alphabet='):]
+                break
+            item, _, rest = rest.partition(',')
+            key, eq, value = item.partition('=')
+            if not eq:
+                raise PolicyError("Invalid policy setting: %s" % item)
+            if key == 'length':
+                try:
+                    kwargs['length'] = int(value)
+                except ValueError:
+                    raise PolicyError("Password length is not an int: %s" % value)
+            elif key in ('classes', 'require'):
+                kwargs[key] = [c for c in value.split('+') if c]
+            else:
+                raise PolicyError("Unknown policy setting: %s" % key)
+        return cls(**kwargs)
+
+    def __repr__(self):
+        return 'assword.policy.Policy(length=%d, alphabet=%r, require=%r)' % (
+            self.length, self.alphabet, self.require)
+
+    def _fill(self, nchars):
+        # keep at least nchars alphabet characters in the pool
+        while len(self._pool) < nchars:
+            nbytes = max(POOL_BYTES, 2 * (nchars - len(self._pool)))
+            self._pool += os.urandom(nbytes).translate(self._table, self._reject)
+
+    def _acceptable(self, pw):
+        for others in self._others:
+            if not pw.translate(None, others):
+                return False
+        return True
+
+    def generate(self):
+        """Return a new password."""
+        return self.generate_batch(1)[0]
+
+    def generate_batch(self, count):
+        """Return a list of count new passwords.
+
+        The random bytes for the whole batch are drawn at once, so
+        this is much faster than count calls to generate().
+
+        """
+        length = self.length
+        passwords = []
+        while len(passwords) < count:
+            need = (count - len(passwords)) * length
+            self._fill(need)
+            pool = self._pool
+            for i in range(0, need, length):
+                pw = pool[i:i+length]
+                if self._acceptable(pw):
+                    passwords.append(pw.decode('ascii'))
+            self._pool = pool[need:]
+        return passwords
+
+def load_policies(path):
+    """Named policies from the JSON file at path.
+
+    The file holds an object mapping policy names to objects with the
+    Policy arguments (length, classes, require, alphabet), and
+    optionally 'match', a list of shell-style patterns of the
+    contexts the policy is for (see select()).  Returns an ordered
+    dict of name to (Policy, patterns), which is empty if the file
+    does not exist.
+
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        raise PolicyError("Invalid policies file %s: %s" % (path, e))
+    if not isinstance(data, dict):
+        raise PolicyError("Policies file %s must hold a JSON object." % path)
+    policies = {}
+    for name, settings in data.items():
+        if not isinstance(settings, dict):
+            raise PolicyError("Policy %s must be a JSON object." % name)
+        settings = dict(settings)
+        patterns = settings.pop('match', [])
+        try:
+            policies[name] = (Policy(**settings), patterns)
+        except TypeError as e:
+            raise PolicyError("Invalid policy %s: %s" % (name, e))
+    return policies
+
+def select(policies, context):
+    """The first policy in policies whose patterns match context, or None."""
+    for policy, patterns in policies.values():
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(context, pattern):
+                return policy
+    return None
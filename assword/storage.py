@@ -0,0 +1,312 @@
+import io
+import os
+import fcntl
+import threading
+import contextlib
+
+############################################################
+
+# A database is stored as a set of named blobs: 'db' and 'journal'
+# for a single file database, or 'manifest' and 'shard-NNNN' for a
+# sharded one, and 'usage' for either.  Storage backends map those
+# names to wherever the bytes actually live.
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+class FileStorage():
+    """Database stored in the local filesystem at path.
+
+    A single file database is stored in the file at path, with its
+    journal next to it, and a sharded database in a directory at
+    path.  The usage of either is stored next to path.  Replaced
+    files are kept with a '.bak' suffix.  Locks are advisory fcntl
+    locks on path + '.lock'.
+
+    """
+
+    backup = True
+
+    def __init__(self, path):
+        self.path = path
+        # whether each thread holds the lock, as save_async() saves
+        # in another thread while this one may hold it
+        self._held = threading.local()
+
+    def __str__(self):
+        return self.path
+
+    def _path(self, name):
+        if name == 'db':
+            return self.path
+        if name == 'journal':
+            return self.path + '.journal'
+        if name == 'usage':
+            return self.path + '.usage'
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        """True if there is a database in the store."""
+        return os.path.exists(self.path)
+
+    @property
+    def sharded(self):
+        """True if the stored database is sharded."""
+        return os.path.isdir(self.path)
+
+    def create(self, sharded=False):
+        """Prepare the store for a new database."""
+        if sharded:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+
+    def stat(self, name):
+        """Token that changes whenever blob name does, or None if it does not exist."""
+        return _stat(self._path(name))
+
+    def size(self, name):
+        """Size in bytes of blob name, or 0 if it does not exist."""
+        st = self.stat(name)
+        return st[1] if st else 0
+
+    def open(self, name):
+        """Binary file object to read blob name from."""
+        return open(self._path(name), 'rb')
+
+    def read(self, name):
+        """Contents of blob name."""
+        with self.open(name) as f:
+            return f.read()
+
+    @contextlib.contextmanager
+    def writer(self, name):
+        """Context manager giving a binary file to write blob name to.
+
+        What is written atomically replaces the contents of blob name
+        when the with block completes, and is discarded if it raises.
+
+        """
+        path = self._path(name)
+        newpath = path + '.new'
+        try:
+            with open(newpath, 'wb') as f:
+                yield f
+        except:
+            os.remove(newpath)
+            raise
+        if self.backup and os.path.exists(path):
+            os.rename(path, path + '.bak')
+        os.rename(newpath, path)
+
+    def write(self, name, data):
+        """Atomically replace the contents of blob name."""
+        with self.writer(name) as f:
+            f.write(data)
+
+    def append(self, name, data):
+        """Append data to blob name, creating it if needed.
+
+        The data is flushed to disk before this returns.  If it can
+        not all be written, the blob is truncated back to its previous
+        size.
+
+        """
+        with open(self._path(name), 'ab') as f:
+            size = f.tell()
+            try:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            except:
+                f.truncate(size)
+                raise
+
+    def remove(self, name):
+        """Remove blob name if it exists."""
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    @contextlib.contextmanager
+    def lock(self, exclusive=False):
+        """Context manager holding a shared or exclusive lock on the store."""
+        # flock locks belong to the open file, so the lock is only
+        # taken by the outermost caller in each thread; other threads
+        # open the file again, and wait for the lock like any process
+        if getattr(self._held, 'locked', False):
+            yield
+            return
+        try:
+            fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            # readers of a database in a read-only location go ahead
+            # without the lock
+            if exclusive:
+                raise
+            yield
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._held.locked = True
+            yield
+        finally:
+            self._held.locked = False
+            os.close(fd)
+
+    def saved(self):
+        """Called, with the exclusive lock held, after each save."""
+        pass
+
+class GitStorage(FileStorage):
+    """Database stored in a git repository.
+
+    As FileStorage, except that no '.bak' files are kept: instead every
+    save is committed to a git repository in the directory holding the
+    database (or, for a sharded database, in its directory), which is
+    created if needed.
+
+    """
+
+    backup = False
+
+    def _git(self, *args, check=True):
+        # subprocess is only loaded when git is used
+        import subprocess
+        # name the repository explicitly, so that a repository further
+        # up the tree is never used
+        workdir = self._workdir()
+        result = subprocess.run(['git', '--git-dir', os.path.join(workdir, '.git'),
+                                 '--work-tree', workdir] + list(args),
+                                cwd=workdir,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        # reported as OSError, like the other storage failures
+        if check and result.returncode != 0:
+            raise OSError('git %s failed: %s' % (args[0], result.stderr.strip()))
+        return result
+
+    def _workdir(self):
+        if self.sharded:
+            return self.path
+        return os.path.dirname(os.path.abspath(self.path))
+
+    def saved(self):
+        if not os.path.isdir(os.path.join(self._workdir(), '.git')):
+            self._git('init', '-q')
+        if self.sharded:
+            self._git('add', '-A', '--', '.', ':(exclude)*.new')
+        else:
+            # the database and its journal, including the removal of
+            # a compacted journal; the usage is local to this machine
+            base = os.path.basename(self.path)
+            self._git('add', '-A', '--', base + '*',
+                      ':(exclude)%s.lock' % base, ':(exclude)%s.new' % base,
+                      ':(exclude)%s.usage*' % base)
+        if self._git('diff', '--cached', '--quiet', check=False).returncode != 0:
+            self._git('commit', '-q', '-m', 'assword: update database')
+
+class MemoryStorage():
+    """Database stored in memory, for tests and benchmarks.
+
+    The blobs are kept in the blobs dict.
+
+    """
+
+    def __init__(self):
+        self.blobs = {}
+        self._generation = 0
+        self._stats = {}
+        self._lock = threading.RLock()
+
+    def __str__(self):
+        return '<memory>'
+
+    def exists(self):
+        return 'db' in self.blobs or 'manifest' in self.blobs
+
+    @property
+    def sharded(self):
+        return 'manifest' in self.blobs
+
+    def create(self, sharded=False):
+        pass
+
+    def _touch(self, name):
+        self._generation += 1
+        self._stats[name] = self._generation
+
+    def stat(self, name):
+        if name not in self.blobs:
+            return None
+        return (self._stats[name], len(self.blobs[name]))
+
+    def size(self, name):
+        return len(self.blobs.get(name, b''))
+
+    def open(self, name):
+        return io.BytesIO(self.read(name))
+
+    def read(self, name):
+        try:
+            return self.blobs[name]
+        except KeyError:
+            raise FileNotFoundError(name)
+
+    @contextlib.contextmanager
+    def writer(self, name):
+        f = io.BytesIO()
+        yield f
+        self.blobs[name] = f.getvalue()
+        self._touch(name)
+
+    def write(self, name, data):
+        self.blobs[name] = bytes(data)
+        self._touch(name)
+
+    def append(self, name, data):
+        self.blobs[name] = self.blobs.get(name, b'') + data
+        self._touch(name)
+
+    def remove(self, name):
+        self.blobs.pop(name, None)
+
+    @contextlib.contextmanager
+    def lock(self, exclusive=False):
+        with self._lock:
+            yield
+
+    def saved(self):
+        pass
+
+############################################################
+
+class CommandHook():
+    """Hook running an external command.
+
+    The command is run with ASSWORD_DB in its environment set to the
+    location of the database.  If background is True the command is
+    started in a new session and not waited for, so that it can keep
+    running after assword exits; otherwise the database reports it if
+    it fails (see Database.hook_errors for post-save hooks).
+
+    """
+
+    def __init__(self, argv, background=False):
+        self.argv = argv
+        self.background = background
+
+    def __call__(self, db):
+        import subprocess
+        env = dict(os.environ)
+        env['ASSWORD_DB'] = str(db.storage)
+        if self.background:
+            subprocess.Popen(self.argv, env=env,
+                             stdin=subprocess.DEVNULL,
+                             stdout=subprocess.DEVNULL,
+                             start_new_session=True)
+        else:
+            subprocess.run(self.argv, env=env, stdin=subprocess.DEVNULL, check=True)
@@ -0,0 +1,100 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+############################################################
+
+# Timed spans of the phases of loading, searching and saving a
+# database, for finding out where the time goes on real machines.
+# Tracing is off unless enable() is called (the command line does so
+# when ASSWORD_TRACE is set), and span() costs next to nothing when it
+# is.
+
+class Tracer():
+    """Recorder of timed spans.
+
+    Each span is recorded as a dict with its name, its start time and
+    duration in seconds (start relative to when the Tracer was
+    created), the thread it ran in, its nesting depth in that thread,
+    and any further information given for it, such as sizes in bytes
+    and entry counts.  If the span raised an exception its type is
+    recorded as 'error'.
+
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._origin = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **info):
+        """Context manager recording a span named name.
+
+        Yields the dict of information recorded for the span, to which
+        more can be added from inside the with block.
+
+        """
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            yield info
+        except BaseException as e:
+            info['error'] = type(e).__name__
+            raise
+        finally:
+            end = time.perf_counter()
+            self._local.depth = depth
+            record = {'name': name,
+                      'start': start - self._origin,
+                      'duration': end - start,
+                      'thread': threading.current_thread().name,
+                      'depth': depth}
+            record.update(info)
+            with self._lock:
+                self.spans.append(record)
+
+    def write(self, path):
+        """Write the spans recorded so far to path as JSON.
+
+        The command line is not written, as it may hold contexts and
+        queries.
+
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s['start'])
+        with open(path, 'w') as f:
+            json.dump({'pid': os.getpid(),
+                       'spans': spans}, f, indent=2)
+            f.write('\n')
+
+_tracer = None
+
+def enable():
+    """Start recording spans, and return the Tracer recording them."""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+def tracer():
+    """The Tracer recording spans, or None if tracing is not enabled."""
+    return _tracer
+
+@contextlib.contextmanager
+def span(name, **info):
+    """Context manager recording a span if tracing is enabled.
+
+    See Tracer.span().  If tracing is not enabled the yielded dict is
+    simply discarded.
+
+    """
+    if _tracer is None:
+        yield info
+        return
+    with _tracer.span(name, **info) as info:
+        yield info
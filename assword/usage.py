@@ -0,0 +1,45 @@
+import time
+
+############################################################
+
+# How often and how recently each context has been retrieved, for
+# ranking.  Usage is kept as a dict of context to [count, last], last
+# being the timestamp of the most recent use.
+
+# seconds over which the weight of past uses halves
+HALF_LIFE = 14 * 24 * 3600
+
+def record(usage, context, now=None):
+    """Count a use of context in usage."""
+    if now is None:
+        now = time.time()
+    count, last = usage.get(context, (0, 0))
+    usage[context] = [count + 1, max(last, now)]
+
+def merge(stored, pending):
+    """Usage with the uses counted in pending added to stored.
+
+    Merging the uses recorded since usage was last saved into the
+    saved usage, rather than overwriting it, keeps the uses recorded
+    by other processes in the meantime.
+
+    """
+    merged = dict(stored)
+    for context, (count, last) in pending.items():
+        c, l = merged.get(context, (0, 0))
+        merged[context] = [c + count, max(l, last)]
+    return merged
+
+def scores(usage, now=None):
+    """Dict of context to ranking score, higher for more used contexts.
+
+    Each context scores its use count, with the weight of the uses
+    halving every HALF_LIFE seconds since the most recent one, so that
+    contexts used often recently come first, and ones used often long
+    ago are eventually overtaken.
+
+    """
+    if now is None:
+        now = time.time()
+    return {context: count * 0.5 ** (max(0, now - last) / HALF_LIFE)
+            for context, (count, last) in usage.items()}
@@ -0,0 +1,89 @@
+"""Helpers shared by the benchmark scripts.
+
+Importing this module puts the source tree first on sys.path, so that
+the assword being benchmarked is the one in this tree.
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+
+SRC_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC_DIRECTORY)
+KEYID = '6D3C87EB41EDE1EC8C7CFAFB032FDE87A6EBD73B'
+
+WORDS = ['mail', 'bank', 'shop', 'forum', 'wiki', 'git', 'cloud', 'vpn',
+         'admin', 'root', 'user', 'team', 'dev', 'prod', 'test', 'backup']
+TLDS = ['com', 'org', 'net', 'io', 'de', 'fr']
+
+############################################################
+
+def best_of(func, runs):
+    """Shortest time in seconds of runs calls of func, and its last result."""
+    best = None
+    for i in range(runs):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def synthetic_contexts(n, seed=0):
+    """n distinct contexts that look like user@host strings."""
+    rng = random.Random(seed)
+    contexts = []
+    for i in range(n):
+        contexts.append('%s%d@%s.%s%d.%s' % (
+            rng.choice(WORDS), i,
+            rng.choice(WORDS), rng.choice(WORDS), rng.randrange(1000),
+            rng.choice(TLDS)))
+    return contexts
+
+def synthetic_db(n, path=None):
+    """Database of n synthetic entries, saved to path if given."""
+    import assword
+    db = assword.Database(path, KEYID)
+    for context in synthetic_contexts(n):
+        db.add(context)
+    if path is not None:
+        db.save()
+    return db
+
+def setup_env(tmpdir):
+    """Environment for running assword against a copy of the test keyring.
+
+    The keyring in test/gnupg is copied into tmpdir, and GNUPGHOME is
+    pointed at the copy in this process too.  Any running agent or
+    resident GUI is bypassed, so that commands are timed from a cold
+    start.
+
+    """
+    gnupghome = os.path.join(tmpdir, 'gnupg')
+    # leave behind the sockets of any agent running on the original
+    shutil.copytree(os.path.join(SRC_DIRECTORY, 'test', 'gnupg'), gnupghome,
+                    ignore=shutil.ignore_patterns('S.*'))
+    os.chmod(gnupghome, 0o700)
+    os.environ['GNUPGHOME'] = gnupghome
+    env = dict(os.environ)
+    env.update({
+        'ASSWORD_KEYID': KEYID,
+        'ASSWORD_AGENT_SOCKET': '',
+        'ASSWORD_GUI_SOCKET': '',
+        'PYTHONPATH': SRC_DIRECTORY + os.pathsep + env.get('PYTHONPATH', ''),
+        'LC_ALL': 'C.UTF-8',
+    })
+    return env
+
+def write_results(results, output=None):
+    """Write results as JSON to the file output, or to stdout."""
+    out = json.dumps(results, sort_keys=True, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Compare two JSON results files written by the benchmarks.
+
+Every number found in both files is reported with its value in each
+and the ratio of the new value to the base one, keyed by its path in
+the results (e.g. "sizes/1000/load"), as JSON on stdout:
+
+  python3 bench/compare.py BASE NEW [-t THRESHOLD] [-o OUTPUT]
+
+With a threshold, only the numbers whose ratio is above it (that is,
+that got slower or larger by more than that factor) are reported, and
+the exit status is 1 if there are any.
+
+"""
+
+import sys
+import json
+import argparse
+
+############################################################
+
+def flatten(results, prefix=''):
+    """dict of path to number for all numbers in results."""
+    numbers = {}
+    for key, value in results.items():
+        path = prefix + str(key)
+        if isinstance(value, dict):
+            numbers.update(flatten(value, path + '/'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            numbers[path] = value
+    return numbers
+
+def compare(base, new):
+    base = flatten(base)
+    new = flatten(new)
+    result = {}
+    for path in sorted(set(base) & set(new)):
+        ratio = new[path] / base[path] if base[path] else None
+        result[path] = {'base': base[path], 'new': new[path], 'ratio': ratio}
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('base', help="results to compare against")
+    parser.add_argument('new', help="results to compare")
+    parser.add_argument('-t', '--threshold', type=float,
+                        help="only report ratios above this, and fail if there are any")
+    parser.add_argument('-o', '--output',
+                        help="write JSON results to file instead of stdout")
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    results = compare(base, new)
+    if args.threshold is not None:
+        results = {path: r for path, r in results.items()
+                   if r['ratio'] is not None and r['ratio'] > args.threshold}
+
+    out = json.dumps(results, sort_keys=True, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+    if args.threshold is not None and results:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
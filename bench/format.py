@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Compare database file size and save/load time across formats.
+
+Synthetic databases are saved as version 1 (indented json), version 2
+(compact json) and version 2 compressed, encrypted to the test key in
+test/gnupg.  For each the cleartext and encrypted file sizes and the
+best save and load times are reported as JSON on stdout:
+
+  python3 bench/format.py [-s SIZE ...] [-n RUNS] [-o OUTPUT]
+
+"""
+
+import os
+import io
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+
+from common import KEYID, best_of, synthetic_db, setup_env, write_results
+
+SIZES = [1000, 10000, 100000]
+
+############################################################
+
+def save_v1(db, path):
+    import assword
+    # what Database.save() wrote before the version 2 format
+    jsondata = {'type': 'assword',
+                'version': 1,
+                'entries': db._entries}
+    cleardata = io.BytesIO(json.dumps(jsondata, indent=2,
+                                      default=assword.entry.entry_default).encode('utf-8'))
+    with open(path, 'wb') as f:
+        db._encryptDB(cleardata, KEYID, f)
+    return len(cleardata.getvalue())
+
+def save_v2(db, path):
+    db.save(path=path)
+    return len(db._encode({'type': 'assword',
+                           'version': db.version,
+                           'entries': db._entries}).getvalue())
+
+def bench_size(n, runs, tmpdir):
+    import assword
+    db = synthetic_db(n)
+    result = {}
+    for name, compress, save in [('v1', False, save_v1),
+                                 ('v2', False, save_v2),
+                                 ('v2-compressed', True, save_v2)]:
+        path = os.path.join(tmpdir, 'db-%s-%d' % (name, n))
+        db.compress = compress
+        t, clearsize = best_of(lambda: save(db, path), runs)
+        result[name] = {
+            'clear_bytes': clearsize,
+            'file_bytes': os.path.getsize(path),
+            'save_s': t,
+            'load_s': best_of(lambda: assword.Database(path), runs)[0],
+        }
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-s', '--size', type=int, action='append',
+                        help="number of entries (may be repeated)")
+    parser.add_argument('-n', '--runs', type=int, default=3,
+                        help="runs per format (best is reported)")
+    parser.add_argument('-o', '--output',
+                        help="write JSON results to file instead of stdout")
+    args = parser.parse_args()
+
+    results = {'python': sys.version.split()[0], 'sizes': {}}
+    tmpdir = tempfile.mkdtemp(prefix='assword-bench.')
+    try:
+        setup_env(tmpdir)
+        for n in args.size or SIZES:
+            results['sizes'][str(n)] = bench_size(n, args.runs, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    write_results(results, args.output)
+
+if __name__ == '__main__':
+    main()
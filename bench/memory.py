@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Measure peak memory used to load and save large databases.
+
+Synthetic databases, encrypted to the test key in test/gnupg, are
+saved and then loaded again, uncompressed and compressed.  The peak
+memory allocated by Python during each (as seen by tracemalloc, so
+not counting gpgme's own buffers), and the memory per entry held by
+the loaded database, are reported as JSON on stdout, along with the
+size of the database file:
+
+  python3 bench/memory.py [-s SIZE ...] [-o OUTPUT]
+
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+
+from common import synthetic_db, setup_env, write_results
+
+SIZES = [10000, 100000, 1000000]
+
+############################################################
+
+def traced(func):
+    # memory still held on return, and peak memory, and the result
+    tracemalloc.start()
+    try:
+        result = func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return current, peak, result
+
+def bench_size(n, tmpdir):
+    import assword
+    db = synthetic_db(n)
+    result = {}
+    for name, compress in [('v2', False), ('v2-compressed', True)]:
+        path = os.path.join(tmpdir, 'db-%s-%d' % (name, n))
+        db.compress = compress
+        save_peak = traced(lambda: db.save(path=path))[1]
+        held, load_peak, loaded = traced(lambda: assword.Database(path))
+        del loaded
+        result[name] = {
+            'file_bytes': os.path.getsize(path),
+            'save_peak_bytes': save_peak,
+            'load_peak_bytes': load_peak,
+            'entry_bytes': held // n,
+        }
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-s', '--size', type=int, action='append',
+                        help="number of entries (may be repeated)")
+    parser.add_argument('-o', '--output',
+                        help="write JSON results to file instead of stdout")
+    args = parser.parse_args()
+
+    results = {'python': sys.version.split()[0], 'sizes': {}}
+    tmpdir = tempfile.mkdtemp(prefix='assword-bench.')
+    try:
+        setup_env(tmpdir)
+        for n in args.size or SIZES:
+            results['sizes'][str(n)] = bench_size(n, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    write_results(results, args.output)
+
+if __name__ == '__main__':
+    main()
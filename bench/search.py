@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Benchmark context search at several database sizes.
+
+Synthetic contexts are indexed with assword.index.ContextIndex and
+queried by substring (short and long queries, case-sensitive and not)
+and fuzzy match.  The linear scan that Database.search used to do is
+timed alongside for comparison.  Results are JSON on stdout:
+
+  python3 bench/search.py [-s SIZE ...] [-o OUTPUT]
+
+"""
+
+import sys
+import time
+import argparse
+
+from common import best_of, synthetic_contexts, write_results
+from assword.index import ContextIndex
+
+SIZES = [10000, 100000, 1000000]
+
+QUERIES = {
+    'short': 'ma',
+    'long': '@bank',
+    'miss': 'zzzzqqq',
+}
+
+############################################################
+
+def bench_size(n, runs):
+    contexts = synthetic_contexts(n)
+    entries = dict.fromkeys(contexts)
+    result = {}
+
+    start = time.perf_counter()
+    index = ContextIndex(entries)
+    result['build_s'] = time.perf_counter() - start
+
+    for name, query in QUERIES.items():
+        t, r = best_of(lambda: [c for c in entries if query in c], runs)
+        result['scan_%s_s' % name] = t
+        t, r = best_of(lambda: index.search(query), runs)
+        result['search_%s_s' % name] = t
+        result['search_%s_hits' % name] = len(r)
+        t, r = best_of(lambda: index.search(query, ignorecase=True), runs)
+        result['isearch_%s_s' % name] = t
+    t, r = best_of(lambda: index.search(QUERIES['short'], limit=10), runs)
+    result['search_short_limit10_s'] = t
+    t, r = best_of(lambda: index.fuzzy('usrbnk', limit=10), runs)
+    result['fuzzy_s'] = t
+
+    # one incremental update followed by a query (forces the lazy
+    # rebuild of the short-query scan string)
+    def update():
+        index.add('bench@update.example')
+        index.remove('bench@update.example')
+        return index.search(QUERIES['short'])
+    t, r = best_of(update, runs)
+    result['update_then_short_search_s'] = t
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-s', '--size', type=int, action='append',
+                        help="number of contexts (may be repeated)")
+    parser.add_argument('-n', '--runs', type=int, default=3,
+                        help="runs per query (best is reported)")
+    parser.add_argument('-o', '--output',
+                        help="write JSON results to file instead of stdout")
+    args = parser.parse_args()
+
+    results = {'python': sys.version.split()[0], 'sizes': {}}
+    for n in args.size or SIZES:
+        results['sizes'][str(n)] = bench_size(n, args.runs)
+
+    write_results(results, args.output)
+
+if __name__ == '__main__':
+    main()
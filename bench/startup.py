@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Measure assword command startup with `python -X importtime`.
+
+Each subcommand is run against a scratch database encrypted to the
+test key in test/gnupg, and the import time report written by the
+interpreter is summarized as JSON on stdout:
+
+  python3 bench/startup.py [-n RUNS] [-o OUTPUT]
+
+For every command the total cumulative import time (microseconds), the
+slowest top-level imports and whether gi/Gtk was loaded are recorded.
+
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+import common
+from common import write_results
+
+# (name, argv, stdin)
+COMMANDS = [
+    ('version', ['version'], None),
+    ('add', ['add', 'bench@startup'], None),
+    ('replace', ['replace', 'bench@startup'], None),
+    ('dump', ['dump'], None),
+    ('remove', ['remove', 'bench@startup'], 'yes\n'),
+]
+
+############################################################
+
+def parse_importtime(stderr):
+    """Parse `-X importtime` output into a list of (self, cumulative, module, depth)."""
+    records = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3:
+            continue
+        try:
+            us_self = int(fields[0])
+            us_cumulative = int(fields[1])
+        except ValueError:
+            # header line
+            continue
+        name = fields[2]
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        records.append((us_self, us_cumulative, name.strip(), depth))
+    return records
+
+def summarize(records, top=10):
+    toplevel = [r for r in records if r[3] == 0]
+    modules = set(r[2] for r in records)
+    return {
+        'total_us': sum(r[1] for r in toplevel),
+        'modules': len(modules),
+        'gi_loaded': 'gi' in modules,
+        'gtk_loaded': 'gi.repository.Gtk' in modules,
+        'slowest': [{'module': r[2], 'cumulative_us': r[1]}
+                    for r in sorted(toplevel, key=lambda r: r[1], reverse=True)[:top]],
+    }
+
+def run(env, argv, stdin=None):
+    cmd = [sys.executable, '-X', 'importtime', '-m', 'assword'] + argv
+    p = subprocess.run(cmd, env=env, input=stdin,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       universal_newlines=True)
+    return p.returncode, p.stderr
+
+def setup_env(tmpdir):
+    env = common.setup_env(tmpdir)
+    env['ASSWORD_DB'] = os.path.join(tmpdir, 'db')
+    return env
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--runs', type=int, default=5,
+                        help="runs per command (best is reported)")
+    parser.add_argument('-o', '--output',
+                        help="write JSON results to file instead of stdout")
+    args = parser.parse_args()
+
+    results = {'python': sys.version.split()[0], 'commands': {}}
+    tmpdir = tempfile.mkdtemp(prefix='assword-bench.')
+    try:
+        env = setup_env(tmpdir)
+        # seed the database so that dump/replace/remove have something to do
+        run(env, ['add', 'bench@seed'])
+        for name, argv, stdin in COMMANDS:
+            best = None
+            for i in range(args.runs):
+                # keep the database state the same for each run
+                if name in ('replace', 'remove'):
+                    run(env, ['add', 'bench@startup'])
+                code, stderr = run(env, argv, stdin)
+                if name == 'add':
+                    run(env, ['remove', 'bench@startup'], 'yes\n')
+                summary = summarize(parse_importtime(stderr))
+                summary['returncode'] = code
+                if best is None or summary['total_us'] < best['total_us']:
+                    best = summary
+            results['commands'][name] = best
+        # the gui command can not be run headless, so just time the
+        # import of the module it loads on top of the CLI
+        cmd = [sys.executable, '-X', 'importtime', '-c', 'import assword.gui']
+        p = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, universal_newlines=True)
+        results['commands']['gui-import'] = summarize(parse_importtime(p.stderr))
+        results['commands']['gui-import']['returncode'] = p.returncode
+    finally:
+        shutil.rmtree(tmpdir)
+
+    write_results(results, args.output)
+
+if __name__ == '__main__':
+    main()
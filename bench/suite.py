@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""Time the main assword operations on synthetic databases.
+
+For each size a synthetic database is created, encrypted to the test
+key in test/gnupg from a copy of that keyring in a throwaway
+GNUPGHOME, and the following are timed (best of RUNS):
+
+  load     opening the database (assword.Database)
+  search   a substring and a fuzzy search, on a freshly loaded database
+  add      adding one entry and saving the database
+  pwgen    generating one password (mean over many calls)
+  policy   generating one password with the default assword.Policy,
+           in a batch of many
+  dump     `assword dump` run as a command, including startup
+  gui      building the GUI and populating its completion model for a
+           query, and showing the window while the database is opened
+           in the background; needs GTK and a display, and runs under
+           Xvfb if there is no DISPLAY but Xvfb is installed
+
+Results are JSON on stdout, keyed by size and operation, in seconds,
+along with the assword and python versions so that runs of different
+versions can be compared (see bench/compare.py):
+
+  python3 bench/suite.py [-s SIZE ...] [-n RUNS] [-o OUTPUT]
+
+Operations that can not be run are reported as null, with the reason
+under 'skipped'.
+
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+from common import SRC_DIRECTORY, KEYID, best_of, synthetic_db, setup_env, write_results
+
+SIZES = [1000, 10000, 100000, 1000000]
+
+PWGEN_CALLS = 10000
+
+QUERY = '@bank'
+
+# run in a child process, so that GTK is only initialized against the
+# display meant for it
+GUI_SCRIPT = """
+import sys, json, time
+import assword
+from assword.gui import Gui
+db = assword.Database(sys.argv[1], sys.argv[2])
+start = time.perf_counter()
+g = Gui(db)
+built = time.perf_counter()
+g.entry.set_text(sys.argv[3])
+done = time.perf_counter()
+# the window as shown by the gui command, before the database is opened
+show = time.perf_counter()
+Gui(opener=lambda: assword.Database(sys.argv[1], sys.argv[2]))
+shown = time.perf_counter()
+print(json.dumps({'build_s': built - start, 'query_s': done - built,
+                  'show_s': shown - show, 'rows': len(g.liststore)}))
+"""
+
+############################################################
+
+def bench_add(path, runs):
+    import assword
+    db = assword.Database(path, KEYID)
+    count = [0]
+    def add():
+        count[0] += 1
+        db.add('bench%d@add.example.com' % count[0])
+        db.save()
+    t = best_of(add, runs)[0]
+    for i in range(count[0]):
+        db.remove('bench%d@add.example.com' % (i + 1))
+    db.save()
+    return t
+
+def bench_dump(env, runs):
+    cmd = [sys.executable, '-m', 'assword', 'dump']
+    def dump():
+        subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=True)
+    return best_of(dump, runs)[0]
+
+def bench_gui(env, path, runs):
+    cmd = [sys.executable, '-c', GUI_SCRIPT, path, KEYID, QUERY]
+    best = None
+    for i in range(runs):
+        p = subprocess.run(cmd, env=env, stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL, universal_newlines=True,
+                           check=True)
+        result = json.loads(p.stdout)
+        if best is None or result['build_s'] + result['query_s'] \
+           < best['build_s'] + best['query_s']:
+            best = result
+    return best
+
+def bench_size(n, runs, tmpdir, env, skipped):
+    import assword
+    path = os.path.join(tmpdir, 'db-%d' % n)
+    synthetic_db(n, path)
+    result = {'file_bytes': os.path.getsize(path)}
+    result['load'] = best_of(lambda: assword.Database(path), runs)[0]
+    result['search'] = best_of(lambda: assword.Database(path).search(QUERY), runs)[0]
+    result['search_fuzzy'] = best_of(lambda: assword.Database(path).search(QUERY, fuzzy=True),
+                                     runs)[0]
+    result['add'] = bench_add(path, runs)
+    result['dump'] = bench_dump(dict(env, ASSWORD_DB=path), runs)
+    if 'gui' in skipped:
+        result['gui'] = None
+    else:
+        result['gui'] = bench_gui(env, path, runs)
+    os.remove(path)
+    return result
+
+def bench_pwgen(runs):
+    import assword
+    def pwgen():
+        for i in range(PWGEN_CALLS):
+            assword.pwgen(assword.DEFAULT_NEW_PASSWORD_OCTETS)
+    return best_of(pwgen, runs)[0] / PWGEN_CALLS
+
+def bench_policy(runs):
+    import assword
+    policy = assword.Policy()
+    return best_of(lambda: policy.generate_batch(PWGEN_CALLS), runs)[0] / PWGEN_CALLS
+
+def start_display(env, skipped):
+    # returns the Xvfb process started, if any
+    try:
+        subprocess.run([sys.executable, '-c', 'import gi'], env=env, check=True,
+                       stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        skipped['gui'] = 'gi not available'
+        return None
+    if env.get('DISPLAY'):
+        return None
+    if not shutil.which('Xvfb'):
+        skipped['gui'] = 'no DISPLAY and Xvfb not found'
+        return None
+    # Xvfb writes the display number it picked to the given fd
+    r, w = os.pipe()
+    xvfb = subprocess.Popen(['Xvfb', '-displayfd', str(w), '-nolisten', 'tcp'],
+                            pass_fds=[w], stderr=subprocess.DEVNULL)
+    os.close(w)
+    with os.fdopen(r) as f:
+        display = f.readline().strip()
+    env['DISPLAY'] = ':' + display
+    return xvfb
+
+def versions():
+    import assword
+    result = {'python': sys.version.split()[0],
+              'assword': assword.__version__}
+    p = subprocess.run(['git', '-C', SRC_DIRECTORY, 'describe', '--always', '--dirty'],
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                       universal_newlines=True)
+    if p.returncode == 0:
+        result['git'] = p.stdout.strip()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-s', '--size', type=int, action='append',
+                        help="number of entries (may be repeated)")
+    parser.add_argument('-n', '--runs', type=int, default=3,
+                        help="runs per operation (best is reported)")
+    parser.add_argument('-o', '--output',
+                        help="write JSON results to file instead of stdout")
+    args = parser.parse_args()
+
+    results = versions()
+    results['sizes'] = {}
+    skipped = {}
+    tmpdir = tempfile.mkdtemp(prefix='assword-bench.')
+    xvfb = None
+    try:
+        env = setup_env(tmpdir)
+        xvfb = start_display(env, skipped)
+        results['pwgen'] = bench_pwgen(args.runs)
+        results['policy'] = bench_policy(args.runs)
+        for n in args.size or SIZES:
+            results['sizes'][str(n)] = bench_size(n, args.runs, tmpdir, env, skipped)
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+            xvfb.wait()
+        shutil.rmtree(tmpdir)
+    results['skipped'] = skipped
+
+    write_results(results, args.output)
+
+if __name__ == '__main__':
+    main()
@@ -8,3 +8,4 @@ alias assword="python -m assword"
 export ASSWORD_DB="$TMP_DIRECTORY"/db
 export GNUPGHOME="$TEST_DIRECTORY"/gnupg
 export ASSWORD_KEYID=6D3C87EB41EDE1EC8C7CFAFB032FDE87A6EBD73B
+export ASSWORD_AGENT_SOCKET=